@@ -0,0 +1,161 @@
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+from bson.objectid import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import compression
+
+"""
+Author: Enigma Zhang
+
+Description:
+    Benchmark of bytes and CPU cost of the compression of compression.py on a chat corpus, for the three places it
+    applies: message content in the database, gzip of history responses and permessage-deflate on /api/push.
+
+    The corpus is generated like chat traffic: mostly short lines, some paragraphs and a few pasted logs or code
+    blocks. --corpus reads a real one instead, a text file with one message per line.
+
+    python bench_compression.py --messages 20000 --history 500
+"""
+
+WORDS = ("ok", "yes", "no", "thanks", "lol", "see", "you", "tomorrow", "meeting", "at", "the", "office", "what",
+         "about", "lunch", "deploy", "is", "done", "can", "someone", "review", "my", "PR", "please", "haha", "sure",
+         "I", "think", "we", "should", "ship", "it", "today", "好的", "谢谢", "明天", "见", "👍", "🎉")
+LOG_LINE = "2020-09-{:02d} 12:{:02d}:{:02d} WARNING tornado.application: API using error: ValueError('{}')"
+CODE = ("def handler(self, roomId):\n    room = await self.settings['db'].room.find_one({'_id': roomId})\n"
+        "    if room is None:\n        raise ValueError('Room id not exists.')\n    return room\n")
+
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def generate_corpus(num, seed=1):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(num):
+        kind = rng.random()
+        if kind < 0.70:
+            corpus.append(sentence(rng, rng.randint(1, 12)))
+        elif kind < 0.90:
+            corpus.append(". ".join(sentence(rng, rng.randint(5, 15)) for _ in range(rng.randint(3, 10))))
+        elif kind < 0.98:
+            corpus.append("\n".join(LOG_LINE.format(rng.randint(1, 30), rng.randint(0, 59), rng.randint(0, 59),
+                                                    sentence(rng, 3)) for _ in range(rng.randint(5, 40))))
+        else:
+            corpus.append(CODE * rng.randint(10, 60))
+    return corpus
+
+
+def as_messages(corpus):
+    room_id = str(ObjectId())
+    return [{
+        "_id": ObjectId(),
+        "userId": str(ObjectId()),
+        "roomId": room_id,
+        "message_type": "text",
+        "content": text,
+        "create_time": 1600000000 + i,
+        "seq": i + 1,
+    } for i, text in enumerate(corpus)]
+
+
+def content_bytes(document):
+    content = document["content"]
+    return len(content) if isinstance(content, bytes) else len(content.encode("utf-8"))
+
+
+def bench_storage(messages, thresholds):
+    raw = sum(content_bytes(m) for m in messages)
+    print("storage: {} messages, {:.0f}KiB of content".format(len(messages), raw / 1024))
+    print("  {:<10}{:>12}{:>10}{:>12}{:>14}{:>16}".format(
+        "threshold", "stored KiB", "ratio", "compressed", "pack us/msg", "unpack us/msg"))
+    for threshold in thresholds:
+        start = time.perf_counter()
+        documents = [compression.pack_content(m, threshold) for m in messages]
+        pack = time.perf_counter() - start
+        stored = sum(content_bytes(d) for d in documents)
+        packed = [dict(d) for d in documents if "content_encoding" in d]
+        start = time.perf_counter()
+        for document in packed:
+            compression.unpack_content(document)
+        unpack = time.perf_counter() - start
+        print("  {:<10}{:>12.0f}{:>10.2f}{:>12}{:>14.2f}{:>16.2f}".format(
+            threshold, stored / 1024, stored / raw, len(packed), pack / len(messages) * 1e6,
+            unpack / max(1, len(packed)) * 1e6))
+
+
+def bench_history(messages, history, rounds):
+    responses = [messages[i:i + history] for i in range(0, len(messages) - history + 1, history)][:rounds]
+    bodies = [json.dumps(r, default=str).encode("utf-8") for r in responses]
+    raw = sum(map(len, bodies)) / len(bodies)
+    print("history: {} messages per response, {:.0f}KiB raw".format(history, raw / 1024))
+    print("  {:<10}{:>12}{:>10}{:>16}".format("gzip", "KiB", "ratio", "ms/response"))
+    for level in (1, 6, 9):
+        start = time.perf_counter()
+        sizes = [len(gzip.compress(body, compresslevel=level)) for body in bodies]
+        elapsed = time.perf_counter() - start
+        size = sum(sizes) / len(sizes)
+        print("  {:<10}{:>12.1f}{:>10.2f}{:>16.3f}".format(
+            "level {}".format(level), size / 1024, size / raw, elapsed / len(bodies) * 1000))
+
+
+def deflate_frames(payloads, takeover):
+    """
+        Compressed sizes of permessage-deflate frames, with or without context takeover.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    sizes = []
+    for payload in payloads:
+        if not takeover:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        # The trailing empty block is not sent.
+        sizes.append(len(data) - 4)
+    return sizes
+
+
+def bench_push(messages):
+    payloads = [json.dumps(m, default=str).encode("utf-8") for m in messages]
+    raw = sum(map(len, payloads))
+    print("push: {} messages, {:.1f} bytes per message raw".format(len(payloads), raw / len(payloads)))
+    print("  {:<22}{:>14}{:>10}{:>12}".format("permessage-deflate", "bytes/msg", "ratio", "us/msg"))
+    for takeover in (True, False):
+        start = time.perf_counter()
+        sizes = deflate_frames(payloads, takeover)
+        elapsed = time.perf_counter() - start
+        print("  {:<22}{:>14.1f}{:>10.2f}{:>12.2f}".format(
+            "context takeover" if takeover else "no context takeover", sum(sizes) / len(sizes), sum(sizes) / raw,
+            elapsed / len(payloads) * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--history", type=int, default=500, help="messages per history response")
+    parser.add_argument("--rounds", type=int, default=40, help="history responses to compress")
+    parser.add_argument("--thresholds", default="256,1024,4096", help="content compression thresholds to try")
+    parser.add_argument("--corpus", help="text file with one message per line instead of the generated corpus")
+    args = parser.parse_args()
+
+    if args.corpus:
+        with open(args.corpus, encoding="utf-8") as f:
+            corpus = [line.rstrip("\n") for line in f if line.strip()][:args.messages]
+    else:
+        corpus = generate_corpus(args.messages)
+    messages = as_messages(corpus)
+    bench_storage(messages, [int(t) for t in args.thresholds.split(",")])
+    bench_history(messages, min(args.history, len(messages)), args.rounds)
+    bench_push(messages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from tools import Encryption, PasswordPool
+
+"""
+Author: Enigma Zhang
+
+Description:
+    Benchmark of the event loop latency during concurrent logins, with bcrypt run inline on the event loop as
+    before and with bcrypt run in the PasswordPool.
+
+    python bench_password.py --logins 32 --workers 4
+"""
+
+
+async def sample_lag(interval, samples, stop):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - start - interval)
+
+
+async def run(logins, validation):
+    hashed = Encryption.encryption("password123")
+    samples = []
+    stop = asyncio.Event()
+    sampler = asyncio.ensure_future(sample_lag(0.005, samples, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*[validation("password123", hashed) for _ in range(logins)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await sampler
+    samples = sorted(samples) or [0.0]
+    return elapsed, samples[len(samples) // 2], samples[-1]
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    async def inline(plain, password):
+        return Encryption.validation(plain, password)
+
+    pool = PasswordPool(max_workers=args.workers, max_pending=args.logins)
+    for name, validation in (("inline", inline), ("pool", pool.validation)):
+        elapsed, median, worst = await run(args.logins, validation)
+        print("{:<7} {} logins in {:.3f}s, event loop lag median {:.1f}ms max {:.1f}ms".format(
+            name, args.logins, elapsed, median * 1000, worst * 1000))
+    pool.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
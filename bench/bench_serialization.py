@@ -0,0 +1,117 @@
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from bson.objectid import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import serialization
+
+"""
+Author: Enigma Zhang
+
+Description:
+    Benchmark of peak memory and latency of encoding a history of 500 messages, the old way (convert every _id in a
+    loop then json.dumps the whole list) against serialization.write_list with every available encoder.
+
+    python bench_serialization.py --messages 500 --rounds 200
+"""
+
+
+class _Sink:
+    """
+        Stands in for a RequestHandler, flush drops what was written like a sent chunk.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.bytes = 0
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+
+    async def flush(self):
+        self.bytes += sum(map(len, self.chunks))
+        self.chunks = []
+
+
+class _Cursor:
+    def __init__(self, documents):
+        self._documents = documents
+
+    def __aiter__(self):
+        self._iterator = iter(self._documents)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+def messages(num):
+    room_id = str(ObjectId())
+    return [{
+        "_id": ObjectId(),
+        "userId": str(ObjectId()),
+        "roomId": room_id,
+        "message_type": "text",
+        "content": "Message number {} of the benchmark, long enough to look like a real chat line.".format(i),
+        "create_time": 1600000000 + i,
+        "seq": i + 1,
+    } for i in range(num)]
+
+
+def old_way(documents):
+    for i in documents:
+        i["_id"] = str(i["_id"])
+    return json.dumps(documents)
+
+
+def new_way(documents):
+    sink = _Sink()
+    coroutine = serialization.write_list(sink, _Cursor(documents), batch_size=100)
+    try:
+        coroutine.send(None)
+    except StopIteration:
+        pass
+    return sink
+
+
+def measure(name, fn, num, rounds):
+    tracemalloc.start()
+    documents = messages(num)
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    fn(documents)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    elapsed = 0
+    for _ in range(rounds):
+        documents = messages(num)
+        start = time.perf_counter()
+        fn(documents)
+        elapsed += time.perf_counter() - start
+    print("{:<16} {:.3f}ms per response, peak {:.0f}KiB above the documents".format(
+        name, elapsed / rounds * 1000, peak / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    measure("json.dumps", old_way, args.messages, args.rounds)
+    for name in serialization.ENCODERS:
+        serialization.use_encoder(name)
+        measure("write_list " + name, new_way, args.messages, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
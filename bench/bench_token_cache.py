@@ -0,0 +1,55 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import aredis
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from tools import auth_with_token, token_generate, TokenCache
+
+"""
+Author: Enigma Zhang
+
+Description:
+    Micro-benchmark of auth_with_token with and without the token cache against a local Redis.
+
+    python bench_token_cache.py --requests 20000 --concurrency 100
+"""
+
+
+async def run(my_redis, token, requests, concurrency, token_cache):
+    async def worker(num):
+        for _ in range(num):
+            assert await auth_with_token(my_redis, token, token_cache)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(requests // concurrency) for _ in range(concurrency)])
+    return requests // concurrency * concurrency / (time.perf_counter() - start)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--redis-host", default="127.0.0.1")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    args = parser.parse_args()
+
+    my_redis = aredis.StrictRedis(host=args.redis_host, port=args.redis_port, db=0)
+    uid = "bench-token-cache"
+    token = token_generate(uid)
+    await my_redis.set(uid, token)
+    try:
+        without_cache = await run(my_redis, token, args.requests, args.concurrency, None)
+        with_cache = await run(my_redis, token, args.requests, args.concurrency, TokenCache())
+    finally:
+        await my_redis.delete(uid)
+    print("without cache: {:.0f} requests/s".format(without_cache))
+    print("with cache:    {:.0f} requests/s".format(with_cache))
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,70 @@
+import argparse
+import os
+import sys
+import timeit
+
+from cerberus import Validator
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import domains
+
+"""
+Author: Enigma Zhang
+
+Description:
+    Benchmark of the precompiled validators of domains.py against Cerberus on realistic payloads.
+
+    python bench_validation.py --number 100000
+"""
+
+PAYLOADS = {
+    "message": (domains.message_validator, {
+        "userId":
+            {"type": "string", "regex": "^[0-9a-fA-F]{24}$"},
+        "roomId":
+            {"type": "string", "regex": "^[0-9a-fA-F]{24}$"},
+        "message_type":
+            {"type": "string", "allowed": ["text", "image", "file"]},
+        "content":
+            {}
+    }, {
+        "userId": "5f1d7a3b9c8e4a2b1c0d9e8f",
+        "roomId": "5f1d7a3b9c8e4a2b1c0d9e90",
+        "message_type": "text",
+        "content": "Are we still meeting at seven tonight? I can bring the slides."
+    }),
+    "user": (domains.user_validator, {
+        "name":
+            {"type": "string", "regex": "[\u00ff-\uffff0-9a-zA-z]+", "min": 1, "max": 32},
+        "phoneNumber":
+            {"type": "string", "regex": "[0-9]+", "min": 1, "max": 20},
+        "password":
+            {"type": "string", "regex": "[0-9a-zA-z]+", "min": 1, "max": 32},
+        "rooms":
+            {"type": "list"}
+    }, {
+        "name": "Enigma",
+        "phoneNumber": "13800138000",
+        "password": "abcDEF123456",
+        "rooms": []
+    }),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=100000)
+    args = parser.parse_args()
+
+    for name, (fast, schema, payload) in PAYLOADS.items():
+        cerberus = Validator(require_all=True)
+        assert fast.validate(payload) and cerberus.validate(payload, schema)
+        cerberus_time = timeit.timeit(lambda: cerberus.validate(payload, schema), number=args.number)
+        fast_time = timeit.timeit(lambda: fast.validate(payload), number=args.number)
+        print("{:<8} cerberus {:.2f}us  fast {:.2f}us  speedup {:.0f}x".format(
+            name, cerberus_time / args.number * 1e6, fast_time / args.number * 1e6, cerberus_time / fast_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+
+import motor.motor_tornado
+from bson.objectid import ObjectId
+
+from loadtest import start_mongod
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import schema
+import store
+
+"""
+Author: Enigma Zhang
+
+Description:
+    Checks the bucket invariants of store.py under concurrent appends.
+
+    Runs many concurrent append_messages calls of random batch sizes into one room of a scratch database, then
+    checks that every seq from 1 to the room counter is given to exactly one message, that no bucket holds more
+    than message_num_per_document messages, that every message is in the bucket of its seq and that
+    room.room_message_id points at every bucket. Exits with 1 if one of them fails.
+
+    python bucket_check.py --start-mongod --appends 2000 --concurrency 200
+"""
+
+
+async def check(args):
+    client = motor.motor_tornado.MotorClient(args.mongo_uri)
+    db = client["chatroom_bucket_check"]
+    await client.drop_database(db.name)
+    await schema.ensure_indexes(db)
+    room_id = (await db.room.insert_one({"name": "bucket check", "members": [], "message_num": 0,
+                                         "room_message_id": []})).inserted_id
+    per_document = args.message_num_per_document
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def append(i):
+        size = 1 + i % args.max_batch
+        messages = [{"userId": str(ObjectId()), "roomId": str(room_id), "message_type": "text",
+                     "content": "bucket check {} {}".format(i, j), "create_time": 1600000000 + i}
+                    for j in range(size)]
+        async with semaphore:
+            await store.append_messages(db, room_id, messages, per_document)
+        return size
+
+    appended = sum(await asyncio.gather(*[append(i) for i in range(args.appends)]))
+
+    errors = []
+    room = await db.room.find_one({"_id": room_id})
+    if room["message_num"] != appended:
+        errors.append("room counter {} for {} messages".format(room["message_num"], appended))
+    seqs = {}
+    async for message in db.message.find({"roomId": str(room_id)}, projection={"seq": 1}):
+        seqs.setdefault(message["seq"], []).append(message["_id"])
+    duplicated = [seq for seq, ids in seqs.items() if len(ids) > 1]
+    if duplicated:
+        errors.append("{} seqs given twice, e.g. {}".format(len(duplicated), duplicated[:5]))
+    if sorted(seqs) != list(range(1, appended + 1)):
+        errors.append("seqs are not 1..{}".format(appended))
+    seq_of = {ids[0]: seq for seq, ids in seqs.items()}
+    bucket_ids = set()
+    async for bucket in db.room_message.find({"room_id": room_id}):
+        bucket_ids.add(bucket["_id"])
+        if len(bucket["messages"]) > per_document:
+            errors.append("bucket {} holds {} messages".format(bucket["index"], len(bucket["messages"])))
+        misplaced = [m for m in bucket["messages"] if (seq_of.get(m, 0) - 1) // per_document != bucket["index"]]
+        if misplaced:
+            errors.append("bucket {} holds {} messages of other buckets".format(bucket["index"], len(misplaced)))
+    if set(i for i in room.get("room_message_id", []) if i is not None) != bucket_ids:
+        errors.append("room.room_message_id does not match the buckets")
+    await client.drop_database(db.name)
+    print("{} appends, {} messages, {} buckets".format(args.appends, appended, len(bucket_ids)))
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mongo-uri", default="mongodb://127.0.0.1:27017")
+    parser.add_argument("--appends", type=int, default=2000, help="append_messages calls")
+    parser.add_argument("--concurrency", type=int, default=200, help="calls in progress at once")
+    parser.add_argument("--max-batch", type=int, default=8, help="messages per call, 1 to this")
+    parser.add_argument("--message-num-per-document", type=int, default=100)
+    parser.add_argument("--start-mongod", action="store_true", help="start mongod from mongod.cfg on port 27017")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="chatroom-bucket-")
+    mongod = None
+    try:
+        if args.start_mongod:
+            mongod = start_mongod(workdir, 27017)
+        errors = asyncio.get_event_loop().run_until_complete(check(args))
+    finally:
+        if mongod is not None:
+            mongod.terminate()
+            mongod.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for error in errors:
+        print("FAILED: {}".format(error))
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
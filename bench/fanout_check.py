@@ -0,0 +1,149 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import tornado.httpclient
+import tornado.websocket
+
+from loadtest import ROOT, Client, Stats, create_rooms, start_mongod, wait_for_port
+
+"""
+Author: Enigma Zhang
+
+Description:
+    Checks that every message sent reaches every push subscriber of its room when the app runs several workers.
+
+    Starts the app with --workers and --partition_routing, which makes worker n also listen on internal_port + n,
+    so that the push sockets can be spread over the workers instead of left to the kernel. Users join rooms, open
+    /api/push on the workers in turn, then send messages through the shared port. Every member of a room must
+    receive every message of the room. Exits with 1 if one is missing.
+
+    python fanout_check.py --start-mongod --start-redis --workers 4 --users 40 --rooms 4 --messages 20
+"""
+
+
+def start_app(port, workers, internal_port):
+    return subprocess.Popen(
+        [sys.executable, "main.py", "--port={}".format(port), "--workers={}".format(workers), "--production",
+         "--partition_routing", "--internal_port={}".format(internal_port), "--rate_limit_mode=off",
+         "--max_in_flight_send=0"],
+        cwd=os.path.join(ROOT, "src"))
+
+
+async def subscribe(client, port, received):
+    """
+        Open /api/push of the client on the worker listening on port, record the contents received by room.
+    """
+    connection = await tornado.websocket.websocket_connect(
+        "ws://127.0.0.1:{}/api/push?token={}".format(port, client.token))
+
+    async def read():
+        while True:
+            payload = await connection.read_message()
+            if payload is None:
+                return
+            message = json.loads(payload)
+            received.setdefault(message["roomId"], set()).add(message["content"])
+
+    asyncio.ensure_future(read())
+    return connection
+
+
+async def run(args):
+    base_url = "http://127.0.0.1:{}".format(args.port)
+    tornado.httpclient.AsyncHTTPClient.configure(None, max_clients=args.users * 2)
+    http = tornado.httpclient.AsyncHTTPClient()
+    stats = Stats()
+    rooms = await create_rooms(base_url, http, args.rooms)
+    clients = []
+    for i in range(args.users):
+        client = Client(base_url, http, stats)
+        if await client.register() and await client.login():
+            await client.join(rooms[i % len(rooms)])
+            clients.append(client)
+    received = [{} for _ in clients]
+    connections = [await subscribe(client, args.internal_port + i % args.workers, received[i])
+                   for i, client in enumerate(clients)]
+    # Subscriptions to the Redis channels of the rooms are made in the background.
+    await asyncio.sleep(args.settle)
+
+    sent = {}
+    for i in range(args.messages):
+        for client in clients:
+            room_id = next(iter(client.rooms))
+            content = "fanout check {} {}".format(client.user_id, i)
+            response = await client.request("send", "POST", "/api/message", {
+                "userId": client.user_id,
+                "roomId": room_id,
+                "message_type": "text",
+                "content": content,
+            })
+            if response.code == 201:
+                sent.setdefault(room_id, set()).add(content)
+
+    deadline = time.monotonic() + args.timeout
+    missing = {}
+    while True:
+        missing = {}
+        for i, client in enumerate(clients):
+            room_id = next(iter(client.rooms))
+            lost = sent.get(room_id, set()) - received[i].get(room_id, set())
+            if lost:
+                missing[client.user_id] = len(lost)
+        if not missing or time.monotonic() > deadline:
+            break
+        await asyncio.sleep(0.2)
+    for connection in connections:
+        connection.close()
+    return len(clients), sum(map(len, sent.values())), missing
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--internal-port", type=int, default=10000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--users", type=int, default=40)
+    parser.add_argument("--rooms", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=20, help="messages sent by each user")
+    parser.add_argument("--settle", type=float, default=2, help="seconds to wait after the sockets are open")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds to wait for the deliveries")
+    parser.add_argument("--start-mongod", action="store_true", help="start mongod from mongod.cfg on port 27017")
+    parser.add_argument("--start-redis", action="store_true", help="start redis-server on port 6379")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="chatroom-fanout-")
+    processes = []
+    try:
+        if args.start_mongod:
+            processes.append(start_mongod(workdir, 27017))
+        if args.start_redis:
+            processes.append(subprocess.Popen(["redis-server", "--port", "6379", "--save", "", "--dir", workdir]))
+            wait_for_port(6379)
+        processes.append(start_app(args.port, args.workers, args.internal_port))
+        wait_for_port(args.port)
+        for n in range(args.workers):
+            wait_for_port(args.internal_port + n)
+        users, sent, missing = asyncio.get_event_loop().run_until_complete(run(args))
+    finally:
+        for process in reversed(processes):
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print("{} users on {} workers, {} messages sent, {} users missed messages".format(
+        users, args.workers, sent, len(missing)))
+    for user_id, num in missing.items():
+        print("FAILED: user {} missed {} messages".format(user_id, num))
+    sys.exit(1 if missing else 0)
+
+
+if __name__ == "__main__":
+    main()
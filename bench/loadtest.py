@@ -0,0 +1,320 @@
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import tornado.httpclient
+
+"""
+Author: Enigma Zhang
+
+Description:
+    Load generation and latency benchmark of the whole API.
+
+    Starts the app from src/main.py, optionally with its own mongod (from the shipped mongod.cfg) and redis-server,
+    registers users, logs them in and joins them to rooms, then drives a mixed traffic of registrations, logins,
+    room joins, message sends and history polls. Reports throughput and p50/p99/p999 latency per endpoint and saves
+    the results as JSON so runs can be compared across changes.
+
+    python loadtest.py --start-mongod --start-redis --users 200 --rooms 20 --duration 60 --output results.json
+"""
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# endpoint -> weight in the mixed traffic
+MIX = {
+    "send": 50,
+    "poll": 40,
+    "login": 5,
+    "register": 3,
+    "join": 2,
+}
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+    def record(self, endpoint, latency, ok):
+        self.latencies[endpoint].append(latency)
+        if not ok:
+            self.errors[endpoint] += 1
+
+    def report(self, duration):
+        result = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            result[endpoint] = {
+                "requests": len(latencies),
+                "errors": self.errors[endpoint],
+                "throughput": len(latencies) / duration,
+                "p50_ms": _percentile(latencies, 0.5) * 1000,
+                "p99_ms": _percentile(latencies, 0.99) * 1000,
+                "p999_ms": _percentile(latencies, 0.999) * 1000,
+            }
+        return result
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Client:
+    """
+        A simulated user of the chatroom.
+    """
+
+    def __init__(self, base_url, http, stats):
+        self.base_url = base_url
+        self.http = http
+        self.stats = stats
+        self.phone_number = str(random.randrange(10 ** 10, 10 ** 11))
+        self.password = "pw{}".format(random.randrange(10 ** 8))
+        self.user_id = None
+        self.token = None
+        self.last_write = None
+        # room id -> [update_time, message_num] known by the client
+        self.rooms = {}
+
+    async def request(self, endpoint, method, path, body=None, auth=True):
+        headers = {"Content-Type": "application/json"}
+        if auth and self.token:
+            headers["Authorization"] = "Bearer " + self.token
+        if self.last_write:
+            # Reads of the client after its writes go to the primary.
+            headers["X-Last-Write"] = self.last_write
+        start = time.perf_counter()
+        response = await self.http.fetch(self.base_url + path, method=method, headers=headers,
+                                         body=json.dumps(body) if body is not None else None, raise_error=False)
+        self.stats.record(endpoint, time.perf_counter() - start, response.code < 400)
+        self.last_write = response.headers.get("X-Last-Write", self.last_write)
+        return response
+
+    async def register(self):
+        response = await self.request("register", "POST", "/api/user", {
+            "name": "user{}".format(self.phone_number),
+            "phoneNumber": self.phone_number,
+            "password": self.password,
+            "rooms": [],
+        }, auth=False)
+        if response.code == 201:
+            self.user_id = json.loads(response.body)["_id"]
+        return response.code == 201
+
+    async def login(self):
+        response = await self.request("login", "POST", "/api/session", {
+            "phoneNumber": self.phone_number,
+            "password": self.password,
+        }, auth=False)
+        if response.code == 201:
+            self.token = json.loads(response.body)["token"]
+        return response.code == 201
+
+    async def join(self, room_id):
+        response = await self.request("join", "POST", "/api/room/{}/user/{}".format(room_id, self.user_id), {})
+        if response.code == 201:
+            self.rooms[room_id] = [0, 0]
+
+    async def send(self):
+        room_id = random.choice(list(self.rooms))
+        await self.request("send", "POST", "/api/message", {
+            "userId": self.user_id,
+            "roomId": room_id,
+            "message_type": "text",
+            "content": "load test message {}".format(random.randrange(10 ** 6)),
+        })
+
+    async def poll(self):
+        room_id = random.choice(list(self.rooms))
+        update_time, message_num = self.rooms[room_id]
+        response = await self.request("poll", "GET", "/api/room/{}/latest/{}/{}".format(
+            room_id, update_time, message_num))
+        if response.code == 200:
+            for message in json.loads(response.body):
+                if message.get("seq", 0) > self.rooms[room_id][1]:
+                    self.rooms[room_id] = [message["create_time"], message["seq"]]
+
+
+async def create_rooms(base_url, http, num):
+    rooms = []
+    for i in range(num):
+        response = await http.fetch(base_url + "/api/room", method="POST", body=json.dumps({
+            "name": "room{}".format(i),
+            "members": [],
+            "message_num": 0,
+            "room_message_id": [],
+        }))
+        rooms.append(json.loads(response.body)["_id"])
+    return rooms
+
+
+async def new_client(base_url, http, stats, rooms, rooms_per_user):
+    client = Client(base_url, http, stats)
+    if await client.register() and await client.login():
+        for room_id in random.sample(rooms, min(rooms_per_user, len(rooms))):
+            await client.join(room_id)
+        return client
+    return None
+
+
+async def virtual_user(client, deadline, think_time, spawn):
+    actions = list(MIX)
+    weights = [MIX[action] for action in actions]
+    while time.monotonic() < deadline:
+        action = random.choices(actions, weights)[0]
+        if action == "send" and client.rooms:
+            await client.send()
+        elif action == "poll" and client.rooms:
+            await client.poll()
+        elif action == "login":
+            await client.login()
+        elif action in ("register", "join"):
+            await spawn()
+        if think_time:
+            await asyncio.sleep(random.expovariate(1 / think_time))
+
+
+async def run(args):
+    base_url = "http://127.0.0.1:{}".format(args.port)
+    tornado.httpclient.AsyncHTTPClient.configure(None, max_clients=args.concurrency)
+    http = tornado.httpclient.AsyncHTTPClient()
+    stats = Stats()
+    rooms = await create_rooms(base_url, http, args.rooms)
+
+    setup_start = time.perf_counter()
+    clients = [c for c in await asyncio.gather(*[
+        new_client(base_url, http, stats, rooms, args.rooms_per_user) for _ in range(args.users)]) if c]
+    setup_duration = time.perf_counter() - setup_start
+    setup = stats.report(setup_duration)
+
+    stats = Stats()
+
+    async def spawn():
+        # A new user registers, logs in and joins rooms during the run.
+        await new_client(base_url, http, stats, rooms, args.rooms_per_user)
+
+    start = time.perf_counter()
+    deadline = time.monotonic() + args.duration
+    await asyncio.gather(*[virtual_user(c, deadline, args.think_time, spawn) for c in clients])
+    duration = time.perf_counter() - start
+    return {
+        "setup": {"duration": setup_duration, "endpoints": setup},
+        "mixed": {"duration": duration, "endpoints": stats.report(duration)},
+    }
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("Nothing listening on port {}".format(port))
+
+
+def start_mongod(workdir, port):
+    """
+        Start mongod from the shipped mongod.cfg with paths moved to workdir. The keyFile of the config is left out,
+        the app connects without credentials.
+    """
+    with open(os.path.join(ROOT, "mongod.cfg"), encoding="utf-8") as f:
+        config = f.read()
+    config = re.sub(r"dbPath:.*", "dbPath: {}".format(os.path.join(workdir, "data")), config)
+    config = re.sub(r"path:.*", "path: {}".format(os.path.join(workdir, "mongod.log")), config)
+    config = re.sub(r"port:.*", "port: {}".format(port), config)
+    config = re.sub(r"bindIp:.*", "bindIp: 127.0.0.1", config)
+    config = re.sub(r"security:\s*\n\s*keyFile:.*\n", "", config)
+    os.makedirs(os.path.join(workdir, "data"))
+    config_path = os.path.join(workdir, "mongod.cfg")
+    with open(config_path, "w", encoding="utf-8") as f:
+        f.write(config)
+    process = subprocess.Popen(["mongod", "--config", config_path])
+    wait_for_port(port)
+    if "replSetName" in config:
+        import pymongo
+        admin = pymongo.MongoClient(port=port, directConnection=True).admin
+        admin.command("replSetInitiate", {"_id": re.search(r"replSetName:\s*(\S+)", config).group(1),
+                                          "members": [{"_id": 0, "host": "127.0.0.1:{}".format(port)}]})
+        while not admin.command("hello").get("isWritablePrimary"):
+            time.sleep(0.2)
+    return process
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--workers", type=int, default=1, help="worker processes of the app")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--rooms-per-user", type=int, default=3)
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--concurrency", type=int, default=200, help="max concurrent HTTP connections")
+    parser.add_argument("--think-time", type=float, default=0.1, help="mean pause of a user between requests")
+    parser.add_argument("--start-mongod", action="store_true", help="start mongod from mongod.cfg on port 27017")
+    parser.add_argument("--read-preference", default="primary",
+                        help="read preference of history and profile reads, with --start-mongod it is a single host "
+                             "replica set")
+    parser.add_argument("--start-redis", action="store_true", help="start redis-server on port 6379")
+    parser.add_argument("--no-app", action="store_true", help="use an app already running on --port")
+    parser.add_argument("--output", default="loadtest-{}.json".format(
+        datetime.datetime.now().strftime("%Y%m%d-%H%M%S")))
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="chatroom-loadtest-")
+    processes = []
+    try:
+        if args.start_mongod:
+            processes.append(start_mongod(workdir, 27017))
+        if args.start_redis:
+            processes.append(subprocess.Popen(["redis-server", "--port", "6379", "--save", "", "--dir", workdir]))
+            wait_for_port(6379)
+        if not args.no_app:
+            processes.append(subprocess.Popen(
+                [sys.executable, "main.py", "--port={}".format(args.port), "--workers={}".format(args.workers),
+                 "--production", "--mongo_history_read_preference={}".format(args.read_preference),
+                 "--mongo_profile_read_preference={}".format(args.read_preference)],
+                cwd=os.path.join(ROOT, "src")))
+            wait_for_port(args.port)
+        results = asyncio.get_event_loop().run_until_complete(run(args))
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    results["run"] = {"revision": revision, "time": datetime.datetime.now().isoformat(), "args": vars(args)}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+    for phase in ("setup", "mixed"):
+        print("{} ({:.1f}s)".format(phase, results[phase]["duration"]))
+        print("  {:<10}{:>10}{:>8}{:>10}{:>10}{:>10}{:>10}".format(
+            "endpoint", "requests", "errors", "req/s", "p50 ms", "p99 ms", "p999 ms"))
+        for endpoint, row in results[phase]["endpoints"].items():
+            print("  {:<10}{:>10}{:>8}{:>10.1f}{:>10.2f}{:>10.2f}{:>10.2f}".format(
+                endpoint, row["requests"], row["errors"], row["throughput"], row["p50_ms"], row["p99_ms"],
+                row["p999_ms"]))
+    print("results saved to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
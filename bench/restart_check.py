@@ -0,0 +1,147 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import tornado.httpclient
+
+from loadtest import ROOT, Client, Stats, create_rooms, start_mongod, wait_for_port
+
+"""
+Author: Enigma Zhang
+
+Description:
+    Restarts the app under load and checks that no accepted message is lost.
+
+    Starts the app with --reuse_port, keeps senders posting messages, starts a second app on the same port and sends
+    SIGTERM to the first one, then keeps sending to the second one. Every message answered with 201 must then be
+    in the history of its room. Exits with 1 if one is missing.
+
+    python restart_check.py --start-mongod --start-redis --senders 50 --duration 20
+"""
+
+
+def start_app(port, workers):
+    return subprocess.Popen(
+        [sys.executable, "main.py", "--port={}".format(port), "--workers={}".format(workers), "--production",
+         "--reuse_port", "--rate_limit_mode=off", "--max_in_flight_send=0"],
+        cwd=os.path.join(ROOT, "src"))
+
+
+async def sender(client, deadline, accepted, errors):
+    room_id = next(iter(client.rooms))
+    i = 0
+    while time.monotonic() < deadline:
+        content = "restart check {} {}".format(client.user_id, i)
+        i += 1
+        try:
+            response = await client.request("send", "POST", "/api/message", {
+                "userId": client.user_id,
+                "roomId": room_id,
+                "message_type": "text",
+                "content": content,
+            })
+        except Exception as e:
+            # Refused or reset while the server restarts, the client did not get an answer.
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            await asyncio.sleep(0.05)
+            continue
+        if response.code == 201:
+            accepted.setdefault(room_id, set()).add(content)
+        else:
+            errors[response.code] = errors.get(response.code, 0) + 1
+
+
+async def history(client, room_id, page=500):
+    contents = set()
+    since_seq = 0
+    while True:
+        response = await client.request("poll", "GET", "/api/room/{}/messages?since_seq={}&limit={}".format(
+            room_id, since_seq, page))
+        messages = json.loads(response.body)
+        if not messages:
+            return contents
+        contents.update(m["content"] for m in messages)
+        since_seq = messages[-1]["seq"]
+
+
+async def run(args, restart):
+    base_url = "http://127.0.0.1:{}".format(args.port)
+    tornado.httpclient.AsyncHTTPClient.configure(None, max_clients=args.senders * 2)
+    http = tornado.httpclient.AsyncHTTPClient()
+    stats = Stats()
+    rooms = await create_rooms(base_url, http, args.rooms)
+    clients = []
+    for i in range(args.senders):
+        client = Client(base_url, http, stats)
+        if await client.register() and await client.login():
+            await client.join(rooms[i % len(rooms)])
+            clients.append(client)
+    accepted = {}
+    errors = {}
+    deadline = time.monotonic() + args.duration
+    senders = asyncio.gather(*[sender(c, deadline, accepted, errors) for c in clients])
+    await asyncio.sleep(args.duration / 3)
+    await restart()
+    await senders
+
+    lost = 0
+    for room_id, contents in accepted.items():
+        reader = next(c for c in clients if room_id in c.rooms)
+        stored = await history(reader, room_id)
+        lost += len(contents - stored)
+    return sum(map(len, accepted.values())), lost, errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--senders", type=int, default=50)
+    parser.add_argument("--rooms", type=int, default=5)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--start-mongod", action="store_true", help="start mongod from mongod.cfg on port 27017")
+    parser.add_argument("--start-redis", action="store_true", help="start redis-server on port 6379")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="chatroom-restart-")
+    processes = []
+    apps = []
+
+    async def restart():
+        apps.append(start_app(args.port, args.workers))
+        # Both servers listen on the port until the old one has stopped listening.
+        await asyncio.sleep(3)
+        print("restarting: SIGTERM to the first server")
+        apps[0].send_signal(signal.SIGTERM)
+        await asyncio.get_event_loop().run_in_executor(None, apps[0].wait)
+        print("first server exited with {}".format(apps[0].returncode))
+
+    try:
+        if args.start_mongod:
+            processes.append(start_mongod(workdir, 27017))
+        if args.start_redis:
+            processes.append(subprocess.Popen(["redis-server", "--port", "6379", "--save", "", "--dir", workdir]))
+            wait_for_port(6379)
+        apps.append(start_app(args.port, args.workers))
+        wait_for_port(args.port)
+        accepted, lost, errors = asyncio.get_event_loop().run_until_complete(run(args, restart))
+    finally:
+        for process in reversed(processes + apps):
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print("accepted {} messages, lost {}, errors {}".format(accepted, lost, errors))
+    sys.exit(1 if lost else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import asyncio
+import datetime
+import hashlib
+import sys
+import zlib
+
+import bson
+import motor.motor_tornado
+import tornado.ioloop
+import tornado.log
+from bson.binary import Binary
+from bson.objectid import ObjectId
+
+from compression import unpack_content
+
+"""
+Author: Enigma Zhang
+
+Description:
+    This module archives old message history.
+
+    A full room_message bucket whose newest message is older than min_age is rewritten in place into a
+    self-contained archive: the bodies of its messages, BSON encoded and zlib compressed, are stored in the bucket
+    itself with archived set, and the messages are then removed from the message collection. Reads of archived
+    history fetch the bucket only.
+
+    The job walks the buckets in _id order and saves its position in the archive_state collection, so it resumes
+    where it stopped. The position never passes a bucket that is not archived yet, a bucket of a slow room that
+    fills up later is still found, and archived buckets are left out of the walk. A bucket archived by a run that
+    stopped before deleting its source messages keeps cleaned set to false and is finished by the next run. It
+    pauses between buckets so that it does not compete with live traffic, and every archive is read back and
+    checked before the source messages are deleted.
+
+        python archive.py [--verify] [mongodb uri]
+"""
+
+STATE_ID = "room_message"
+
+
+def pack_messages(messages):
+    data = bson.encode({"messages": messages})
+    return Binary(zlib.compress(data)), hashlib.sha256(data).hexdigest()
+
+
+def unpack_bucket(bucket):
+    """
+        Messages of an archived bucket, in seq order.
+    """
+    return bson.decode(zlib.decompress(bucket["data"]))["messages"]
+
+
+async def read_archived(db, room_id, first_seq, last_seq, message_num_per_document):
+    """
+        Messages with seq between first_seq and last_seq stored in archived buckets of the room.
+    """
+    first_index = max(0, (first_seq - 1) // message_num_per_document)
+    last_index = max(0, (last_seq - 1) // message_num_per_document)
+    messages = []
+    async for bucket in db.room_message.find({"room_id": ObjectId(room_id),
+                                              "index": {"$gte": first_index, "$lte": last_index},
+                                              "archived": True}):
+        messages.extend(m for m in unpack_bucket(bucket) if first_seq <= m["seq"] <= last_seq)
+    return messages
+
+
+async def newest_first(cursor, archived, limit):
+    """
+        Iterate the messages of a cursor sorted newest first, then the older archived messages, at most limit. Their
+        content is decompressed as they are written.
+    """
+    num = 0
+    if cursor is not None:
+        async for message in cursor:
+            yield unpack_content(message)
+            num += 1
+    for message in sorted(archived, key=lambda m: m["seq"], reverse=True):
+        if num >= limit:
+            return
+        yield unpack_content(message)
+        num += 1
+
+
+class ArchiveJob:
+    """
+        Resumable and throttled compaction of old buckets, see the module description.
+    """
+
+    def __init__(self, db, message_num_per_document, min_age=datetime.timedelta(days=30), pause=0.05,
+                 delete_source=True):
+        self._db = db
+        self._message_num_per_document = message_num_per_document
+        self._min_age = min_age
+        self._pause = pause
+        self._delete_source = delete_source
+        self.archived = 0
+
+    async def run(self, max_buckets=None):
+        """
+            Archive the candidate buckets after the saved position, return the number archived.
+        """
+        state = await self._db.archive_state.find_one({"_id": STATE_ID})
+        last_id = state["last_id"] if state else ObjectId("0" * 24)
+        cutoff = ObjectId.from_datetime(datetime.datetime.utcnow() - self._min_age)
+        await self.finish_archives()
+        # Archived buckets never hold the position back, only buckets still to archive do.
+        query = {"_id": {"$gt": last_id, "$lt": cutoff}, "archived": {"$ne": True}}
+        num = 0
+        # The saved position stops before the first bucket skipped, so that the next run looks at it again.
+        skipped = False
+        cursor = self._db.room_message.find(query, projection={"messages": 1, "archived": 1})
+        async for bucket in cursor.sort("_id", 1):
+            if len(bucket["messages"]) < self._message_num_per_document or \
+                    bucket["messages"][-1].generation_time > cutoff.generation_time:
+                # Not full yet, or created before the cutoff but written after it.
+                skipped = True
+                continue
+            await self.archive_bucket(bucket)
+            if not skipped:
+                await self._db.archive_state.update_one({"_id": STATE_ID}, {"$set": {"last_id": bucket["_id"]}},
+                                                        upsert=True)
+            num += 1
+            if max_buckets is not None and num >= max_buckets:
+                break
+            await asyncio.sleep(self._pause)
+        return num
+
+    async def finish_archives(self):
+        """
+            Check and clean the buckets archived by a run that stopped before deleting their source messages, return
+            their number.
+        """
+        num = 0
+        async for bucket in self._db.room_message.find({"cleaned": False}, projection={"messages": 1, "archived": 1}):
+            await self.archive_bucket(bucket)
+            num += 1
+        return num
+
+    async def run_forever(self, interval=3600):
+        while True:
+            try:
+                num = await self.run()
+                if num:
+                    tornado.log.app_log.info("Archived {} message buckets".format(num))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                tornado.log.app_log.warning("Message archive failed: ", exc_info=True)
+            await asyncio.sleep(interval)
+
+    async def archive_bucket(self, bucket):
+        """
+            Archive a bucket and delete its source messages. A bucket archived by a run that stopped before
+            deleting them is only checked and cleaned.
+        """
+        message_ids = None
+        if not bucket.get("archived"):
+            messages = await self._db.message.find({"_id": {"$in": bucket["messages"]}}).sort("seq", 1).to_list(
+                length=None)
+            if len(messages) != len(bucket["messages"]):
+                # Ids of failed inserts have no message, keep what exists.
+                tornado.log.app_log.warning("Bucket {} has {} of {} messages".format(
+                    bucket["_id"], len(messages), len(bucket["messages"])))
+            data, checksum = pack_messages(messages)
+            await self._db.room_message.update_one({"_id": bucket["_id"], "archived": {"$ne": True}}, {"$set": {
+                "archived": True,
+                "data": data,
+                "checksum": checksum,
+                "count": len(messages),
+                "first_seq": messages[0]["seq"] if messages else None,
+                "last_seq": messages[-1]["seq"] if messages else None,
+                # Unset once the source messages are deleted, see finish_archives.
+                "cleaned": False,
+            }})
+            message_ids = [m["_id"] for m in messages]
+        archived = await self._db.room_message.find_one({"_id": bucket["_id"]})
+        if not self.check(archived, message_ids):
+            raise RuntimeError("Archive of bucket {} does not match its messages".format(bucket["_id"]))
+        if self._delete_source and archived["count"]:
+            await self._db.message.delete_many({"_id": {"$in": [m["_id"] for m in unpack_bucket(archived)]}})
+        await self._db.room_message.update_one({"_id": bucket["_id"]}, {"$unset": {"cleaned": ""}})
+        if message_ids is not None:
+            self.archived += 1
+
+    @staticmethod
+    def check(bucket, message_ids=None):
+        """
+            Check that an archived bucket decodes to its checksum and, if given, to exactly message_ids.
+        """
+        try:
+            data = zlib.decompress(bucket["data"])
+        except (KeyError, zlib.error):
+            return False
+        if hashlib.sha256(data).hexdigest() != bucket["checksum"]:
+            return False
+        messages = bson.decode(data)["messages"]
+        if len(messages) != bucket["count"]:
+            return False
+        return message_ids is None or [m["_id"] for m in messages] == list(message_ids)
+
+    async def verify(self):
+        """
+            Check every archived bucket, return the ids of those that fail.
+        """
+        failed = []
+        async for bucket in self._db.room_message.find({"archived": True}):
+            if not self.check(bucket):
+                failed.append(bucket["_id"])
+        return failed
+
+
+if __name__ == "__main__":
+    uri = next((arg for arg in sys.argv[1:] if not arg.startswith("--")), "mongodb://127.0.0.1:27017")
+    job = ArchiveJob(motor.motor_tornado.MotorClient(uri).chatroom, message_num_per_document=100)
+    if "--verify" in sys.argv[1:]:
+        broken = tornado.ioloop.IOLoop.current().run_sync(job.verify)
+        for bucket_id in broken:
+            tornado.log.app_log.error("Broken archive: {}".format(bucket_id))
+        sys.exit(1 if broken else 0)
+    print("Archived {} buckets".format(tornado.ioloop.IOLoop.current().run_sync(job.run)))
@@ -0,0 +1,109 @@
+import asyncio
+import collections
+import contextvars
+
+import tornado.log
+from pymongo.errors import BulkWriteError
+
+from store import append_messages
+
+"""
+Author: Enigma Zhang
+
+Description:
+    This module groups the messages sent to the same room in a short time window into one write.
+
+    Messages of a room are collected for message_batch_linger_ms or until message_batch_max_size of them are
+    waiting, then committed with one counter update, one insert_many and one $push per bucket (see store.py).
+    Every waiting request gets its own result or error. With partitions the messages of a room are written to the
+    database of its partition.
+"""
+
+
+class MessageBatcher:
+    """
+        In-process group-commit write batcher, one pending batch per room.
+    """
+
+    def __init__(self, db, message_num_per_document, max_size=64, linger_ms=5, compress_threshold=0, partitions=None):
+        self._db = db
+        self._partitions = partitions
+        self._message_num_per_document = message_num_per_document
+        self._compress_threshold = compress_threshold
+        self._max_size = max_size
+        self._linger = linger_ms / 1000
+        self._pending = {}
+        self._timers = {}
+        self._commits = set()
+        self.batch_num = 0
+        self.message_num = 0
+        # Number of committed batches by size.
+        self.batch_sizes = collections.Counter()
+
+    async def append(self, message):
+        """
+            Queue a message for its room and wait until it is committed. Returns the message with _id and seq set.
+        """
+        room_id = message["roomId"]
+        future = asyncio.get_event_loop().create_future()
+        batch = self._pending.setdefault(room_id, [])
+        batch.append((message, future))
+        if len(batch) >= self._max_size:
+            self._flush(room_id)
+        elif len(batch) == 1:
+            self._timers[room_id] = asyncio.get_event_loop().call_later(self._linger, self._flush, room_id)
+        return await future
+
+    async def flush_all(self):
+        """
+            Commit every pending batch now and wait for all running commits.
+        """
+        for room_id in list(self._pending.keys()):
+            self._flush(room_id)
+        if self._commits:
+            await asyncio.wait(list(self._commits))
+
+    def stats(self):
+        return {
+            "batch_num": self.batch_num,
+            "message_num": self.message_num,
+            "mean_batch_size": self.message_num / self.batch_num if self.batch_num else 0,
+            "batch_sizes": dict(self.batch_sizes),
+        }
+
+    def _flush(self, room_id):
+        timer = self._timers.pop(room_id, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(room_id, None)
+        if batch:
+            # In an empty context, the commit serves the whole batch and its calls are not counted against the
+            # request that happened to flush it, see metrics.py.
+            commit = contextvars.Context().run(asyncio.ensure_future, self._commit(room_id, batch))
+            self._commits.add(commit)
+            commit.add_done_callback(self._commits.discard)
+
+    async def _commit(self, room_id, batch):
+        messages = [message for message, _ in batch]
+        self.batch_num += 1
+        self.message_num += len(batch)
+        self.batch_sizes[len(batch)] += 1
+        failed = {}
+        try:
+            message_db = self._partitions.database(room_id) if self._partitions is not None else None
+            await append_messages(self._db, room_id, messages, self._message_num_per_document,
+                                  self._compress_threshold, message_db)
+        except BulkWriteError as e:
+            tornado.log.app_log.warning("Batch of room {} partly failed: ".format(room_id), exc_info=True)
+            for error in e.details.get("writeErrors", []):
+                failed[error["index"]] = ValueError(error.get("errmsg", "Message insert failed"))
+        except Exception as e:
+            failed = dict.fromkeys(range(len(batch)), e)
+        for i, (message, future) in enumerate(batch):
+            if future.done():
+                # The request was cancelled while waiting.
+                continue
+            if i in failed:
+                future.set_exception(failed[i])
+            else:
+                future.set_result(message)
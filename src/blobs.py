@@ -0,0 +1,195 @@
+import hashlib
+import os
+import re
+import tempfile
+from abc import ABC
+
+import tornado.web
+
+from tools import auth_with_token
+
+"""
+Author: Enigma Zhang
+
+Description:
+    This module stores the files of image and file messages outside of the messages.
+
+    An upload is streamed to a temporary file of the blob directory while its SHA-256 is computed, then moved to
+    a path named after the digest, so the same content is stored once. The blob collection keeps the size and
+    content type of every blob, and messages only refer to a blob by its digest.
+
+    Blobs never change once stored, they are downloaded through StaticFileHandler which answers range requests
+    and conditional requests with the digest as ETag.
+"""
+
+DIGEST = re.compile(r"^[0-9a-f]{64}$")
+
+
+class BlobStore:
+    """
+        Content addressed files under root, a blob is stored at root/{digest[:2]}/{digest}.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self._tmp = os.path.join(self.root, "tmp")
+        os.makedirs(self._tmp, exist_ok=True)
+
+    def path(self, digest):
+        if not DIGEST.match(digest):
+            raise ValueError("Wrong blob id.")
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest):
+        return os.path.isfile(self.path(digest))
+
+    def writer(self):
+        return BlobWriter(self)
+
+
+class BlobWriter:
+    """
+        Writes one upload, commit returns its digest. An upload that is not committed is removed by discard.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._hash = hashlib.sha256()
+        fd, self._tmp_path = tempfile.mkstemp(dir=store._tmp)
+        self._file = os.fdopen(fd, "wb")
+        self.size = 0
+
+    def write(self, chunk):
+        self._hash.update(chunk)
+        self._file.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self):
+        self._file.close()
+        digest = self._hash.hexdigest()
+        path = self._store.path(digest)
+        if os.path.isfile(path):
+            # Already stored.
+            os.remove(self._tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self._tmp_path, path)
+        self._tmp_path = None
+        return digest
+
+    def discard(self):
+        if self._tmp_path is None:
+            return
+        self._file.close()
+        try:
+            os.remove(self._tmp_path)
+        except OSError:
+            pass
+        self._tmp_path = None
+
+
+@tornado.web.stream_request_body
+class BlobUploadHandler(tornado.web.RequestHandler, ABC):
+    """
+    Handle /api/blob, the body of the request is the file.
+    """
+
+    _writer = None
+    _uid = None
+
+    async def prepare(self):
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        if self.request.method != "POST":
+            return
+        authorization = self.request.headers.get("Authorization", "")
+        if authorization.startswith("Bearer"):
+            authorization = authorization[len("Bearer"):].strip()
+        self._uid = await auth_with_token(self.settings["my_redis"], authorization, self.settings["token_cache"])
+        if not self._uid:
+            self.set_status(401)
+            self.finish()
+            return
+        max_size = self.settings["blob_max_size"]
+        self.request.connection.set_max_body_size(max_size)
+        if int(self.request.headers.get("Content-Length", 0)) > max_size:
+            self.set_status(413)
+            self.finish()
+            return
+        self._writer = self.settings["blob_store"].writer()
+
+    def data_received(self, chunk):
+        if self._writer is None:
+            return
+        self._writer.write(chunk)
+        if self._writer.size > self.settings["blob_max_size"]:
+            # Chunked upload without Content-Length.
+            self._writer.discard()
+            self._writer = None
+            self.set_status(413)
+            self.finish()
+
+    async def post(self, *args, **kwargs):
+        """
+        :return: {"blob": digest, "size": size, "content_type": content_type}, 201; None, 400 if the body is empty
+        """
+        if self._writer is None:
+            # Refused while the body was received.
+            return
+        if self._writer.size == 0:
+            self._writer.discard()
+            self.set_status(400)
+            return
+        size = self._writer.size
+        digest = self._writer.commit()
+        content_type = self.request.headers.get("Content-Type", "application/octet-stream")
+        blob = {"size": size, "content_type": content_type, "userId": self._uid}
+        await self.settings["db"].blob.update_one({"_id": digest}, {"$setOnInsert": blob}, upsert=True)
+        self.set_status(201)
+        self.write({"blob": digest, "size": size, "content_type": content_type})
+
+    def on_finish(self):
+        if self._writer is not None:
+            self._writer.discard()
+
+    def on_connection_close(self):
+        if self._writer is not None:
+            self._writer.discard()
+
+
+class BlobHandler(tornado.web.StaticFileHandler, ABC):
+    """
+    Handle /api/blob/{digest}, with range requests and ETag.
+    """
+
+    CACHE_MAX_AGE = 86400 * 365
+    # Raster images are shown inline, every other type is downloaded.
+    INLINE_TYPES = frozenset(("image/png", "image/jpeg", "image/gif", "image/webp"))
+
+    _content_type = None
+
+    async def get(self, digest, include_body=True):
+        if not DIGEST.match(digest):
+            raise tornado.web.HTTPError(404)
+        blob = await self.settings["db"].blob.find_one({"_id": digest})
+        if blob is None:
+            raise tornado.web.HTTPError(404)
+        self._content_type = blob.get("content_type")
+        await super().get(os.path.join(digest[:2], digest), include_body)
+
+    def compute_etag(self):
+        # The digest is the content.
+        return '"{}"'.format(os.path.basename(self.absolute_path))
+
+    def get_content_type(self):
+        return self._content_type or "application/octet-stream"
+
+    def get_cache_time(self, path, modified, mime_type):
+        return self.CACHE_MAX_AGE
+
+    def set_extra_headers(self, path):
+        self.set_header("X-Content-Type-Options", "nosniff")
+        # Nothing served from here may run script, an SVG image can.
+        self.set_header("Content-Security-Policy", "sandbox")
+        if self.get_content_type().split(";")[0].strip().lower() not in self.INLINE_TYPES:
+            # The content type is given by the uploader, do not let browsers render it.
+            self.set_header("Content-Disposition", "attachment")
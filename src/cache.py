@@ -0,0 +1,430 @@
+import asyncio
+import collections
+import json
+import time
+
+import bson
+from bson.objectid import ObjectId
+
+from serialization import dumps
+
+"""
+Author: Enigma Zhang
+
+Description:
+    This module caches hot data of the app in process memory.
+"""
+
+
+class _RoomBuffer:
+    __slots__ = ("messages", "sizes", "bytes", "live")
+
+    def __init__(self):
+        # Messages of contiguous seq, oldest first.
+        self.messages = collections.deque()
+        self.sizes = collections.deque()
+        self.bytes = 0
+        # Whether every message since the first one is in the buffer, see RecentMessageCache._checked.
+        self.live = False
+
+    def first_seq(self):
+        return self.messages[0]["seq"]
+
+    def last_seq(self):
+        return self.messages[-1]["seq"]
+
+
+class RecentMessageCache:
+    """
+        Ring buffers of the latest messages of each room, written through by MessageHandler.post and by messages of
+        other processes received from the fan-out.
+
+        A buffer always holds messages of contiguous seq ending at the latest message known by this process. Rooms
+        are evicted in LRU order when the estimated size of all buffers exceeds max_bytes or there are more than
+        max_rooms of them.
+
+        A buffer is only filled from the database, and only answers reads, once the fan-out subscription of its room
+        is confirmed: before that a message of another process can be missing from it, see live.
+    """
+
+    def __init__(self, room_capacity=500, max_bytes=64 * 1024 * 1024, max_rooms=10000):
+        self._room_capacity = room_capacity
+        self._max_bytes = max_bytes
+        self._max_rooms = max_rooms
+        self._rooms = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Called with a room id when a room enters or leaves the cache.
+        self.on_room_added = None
+        self.on_room_removed = None
+        # Called with a room id, whether the fan-out subscription of the room is confirmed.
+        self.is_live = None
+
+    def on_message(self, room_id, message, payload):
+        """
+            Fan-out listener, message is None for messages of other processes.
+        """
+        if message is None:
+            if room_id not in self._rooms:
+                return
+            message = json.loads(payload)
+        self.append(room_id, message, len(payload))
+
+    def append(self, room_id, message, size):
+        buffer = self._rooms.get(room_id)
+        if buffer is None:
+            buffer = self._add_room(room_id)
+        self._checked(room_id, buffer)
+        if buffer.messages and message["seq"] != buffer.last_seq() + 1:
+            if message["seq"] <= buffer.last_seq():
+                # Already cached, or older than the buffer.
+                return
+            # A message is missing, start again from this one.
+            self._clear(buffer)
+        self._rooms.move_to_end(room_id)
+        self._push(buffer, message, size)
+        self._evict()
+
+    def live(self, room_id):
+        """
+            Call before reading the latest messages of a room from the database. Returns whether they may fill its
+            buffer: the subscription of the room was confirmed before the read, so a message committed after it is
+            received. Otherwise starts watching the room, a later read can fill it.
+        """
+        if room_id not in self._rooms:
+            self._add_room(room_id)
+            self._evict()
+            return False
+        buffer = self._rooms[room_id]
+        self._checked(room_id, buffer)
+        return buffer.live
+
+    def fill(self, room_id, messages):
+        """
+            Cache messages read from the database, oldest first. They must be of contiguous seq, end at the latest
+            message of the room, and be read after live returned True. Only an empty buffer is filled, one that
+            received a message since the read already holds the latest messages.
+        """
+        buffer = self._rooms.get(room_id)
+        if buffer is None or not buffer.live or buffer.messages or not messages:
+            return
+        for message in messages[-self._room_capacity:]:
+            self._push(buffer, message, len(dumps(message)))
+        self._evict()
+
+    def latest(self, room_id, message_num, max_num):
+        """
+            Return the messages after the first message_num messages of the room, newest first and at most max_num
+            of them, or None if the buffer of the room cannot answer.
+        """
+        buffer = self._rooms.get(room_id)
+        if buffer is None or not self._checked(room_id, buffer) or not buffer.messages or \
+                message_num > buffer.last_seq():
+            self.misses += 1
+            return None
+        num = min(buffer.last_seq() - message_num, max_num)
+        if buffer.last_seq() - num + 1 < buffer.first_seq():
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._rooms.move_to_end(room_id)
+        messages = buffer.messages
+        return [messages[i] for i in range(len(messages) - 1, len(messages) - 1 - num, -1)]
+
+    def since(self, room_id, since_seq, limit):
+        """
+            Return the messages of the room with seq greater than since_seq, oldest first and at most limit of them,
+            or None if the buffer of the room cannot answer.
+        """
+        buffer = self._rooms.get(room_id)
+        if buffer is None or not self._checked(room_id, buffer) or not buffer.messages or \
+                not buffer.first_seq() - 1 <= since_seq <= buffer.last_seq():
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._rooms.move_to_end(room_id)
+        start = since_seq - buffer.first_seq() + 1
+        messages = buffer.messages
+        return [messages[i] for i in range(start, min(start + limit, len(messages)))]
+
+    def discard(self, room_id):
+        buffer = self._rooms.pop(room_id, None)
+        if buffer is not None:
+            self.bytes -= buffer.bytes
+            if self.on_room_removed is not None:
+                self.on_room_removed(room_id)
+
+    def rooms(self):
+        return list(self._rooms.keys())
+
+    def stats(self):
+        return {
+            "rooms": len(self._rooms),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _live(self, room_id):
+        return self.is_live is None or self.is_live(room_id)
+
+    def _checked(self, room_id, buffer):
+        """
+            Whether buffer can answer reads. A buffer started before the subscription of its room was confirmed may
+            miss a message of another process, it is emptied once the subscription is confirmed and starts again from
+            the next message.
+        """
+        if buffer.live:
+            return True
+        if self._live(room_id):
+            self._clear(buffer)
+            buffer.live = True
+        return False
+
+    def _add_room(self, room_id):
+        buffer = self._rooms[room_id] = _RoomBuffer()
+        if self.on_room_added is not None:
+            self.on_room_added(room_id)
+        return buffer
+
+    def _push(self, buffer, message, size):
+        buffer.messages.append(message)
+        buffer.sizes.append(size)
+        buffer.bytes += size
+        self.bytes += size
+        if len(buffer.messages) > self._room_capacity:
+            buffer.messages.popleft()
+            size = buffer.sizes.popleft()
+            buffer.bytes -= size
+            self.bytes -= size
+
+    def _clear(self, buffer):
+        buffer.messages.clear()
+        buffer.sizes.clear()
+        self.bytes -= buffer.bytes
+        buffer.bytes = 0
+
+    def _evict(self):
+        while (self.bytes > self._max_bytes or len(self._rooms) > self._max_rooms) and len(self._rooms) > 1:
+            self.discard(next(iter(self._rooms)))
+
+
+class MetadataCache:
+    """
+        Read-through cache of user and room documents, with a TTL and explicit invalidation by the handlers that change
+        them. A Redis second tier lets workers share warm entries, invalidations reach the other workers through the
+        fan-out control channel. A copy read from Redis is kept in memory for another ttl, so without invalidation a
+        document is at most ttl + redis_ttl seconds old.
+
+        Users and rooms are never deleted, so ids known to exist are kept apart without TTL and existence checks are
+        memory lookups. Cached user documents never contain the password.
+    """
+
+    redis_prefix = "chatroom:meta:"
+
+    def __init__(self, db, my_redis=None, ttl=10, redis_ttl=10, max_size=100000):
+        self._db = db
+        self._redis = my_redis
+        self._ttl = ttl
+        self._redis_ttl = redis_ttl
+        self._max_size = max_size
+        self._documents = collections.OrderedDict()
+        self._existing = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Called with (kind, ids) after a local invalidation, to tell the other workers.
+        self.on_invalidate = None
+
+    async def get_user(self, user_id, db=None, fresh=False):
+        """
+            Misses are read from db, the database of the cache by default. fresh skips the cached copies.
+        """
+        return await self._get("user", user_id, {"password": 0}, db, fresh)
+
+    async def get_room(self, room_id, db=None, fresh=False):
+        return await self._get("room", room_id, None, db, fresh)
+
+    async def get_users(self, user_ids, db=None):
+        """
+            Users of user_ids as a dict by id, the misses are read with a single $in query. Unknown ids are left out.
+        """
+        return await self._get_many("user", user_ids, {"password": 0}, db)
+
+    async def get_rooms(self, room_ids, db=None):
+        return await self._get_many("room", room_ids, None, db)
+
+    async def user_exists(self, user_id):
+        return await self._exists("user", user_id)
+
+    async def room_exists(self, room_id):
+        return await self._exists("room", room_id)
+
+    def put(self, kind, document):
+        """
+            Cache a document just inserted by this process.
+        """
+        document = dict(document)
+        document.pop("password", None)
+        key = (kind, str(document["_id"]))
+        self._store(key, document)
+        self._remember(key)
+
+    async def invalidate(self, kind, object_id):
+        """
+            Drop a changed document from every tier and every worker.
+        """
+        await self.invalidate_many(kind, [object_id])
+
+    async def invalidate_many(self, kind, object_ids):
+        object_ids = [str(object_id) for object_id in object_ids]
+        if not object_ids:
+            return
+        self.evict_many(kind, object_ids)
+        if self._redis is not None:
+            await self._redis.delete(*[self._redis_key((kind, object_id)) for object_id in object_ids])
+        if self.on_invalidate is not None:
+            await self.on_invalidate(kind, object_ids)
+
+    def evict(self, kind, object_id):
+        self._documents.pop((kind, str(object_id)), None)
+
+    def evict_many(self, kind, object_ids):
+        for object_id in object_ids:
+            self.evict(kind, object_id)
+
+    def stats(self):
+        return {"documents": len(self._documents), "hits": self.hits, "misses": self.misses}
+
+    async def _exists(self, kind, object_id):
+        key = (kind, str(object_id))
+        if key in self._existing:
+            self._existing.move_to_end(key)
+            return True
+        return await self._get(kind, object_id, {"_id": 1}) is not None
+
+    async def _get(self, kind, object_id, projection, db=None, fresh=False):
+        key = (kind, str(object_id))
+        entry = self._documents.get(key)
+        if not fresh and entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            self._documents.move_to_end(key)
+            return dict(entry[1])
+        self.misses += 1
+        document = None
+        if self._redis is not None and not fresh:
+            data = await self._redis.get(self._redis_key(key))
+            if data is not None:
+                document = bson.decode(data)
+        if document is None:
+            db = self._db if db is None else db
+            document = await db[kind].find_one({"_id": ObjectId(object_id)}, projection=projection)
+            if document is None:
+                return None
+            if projection == {"_id": 1}:
+                # Existence check only.
+                self._remember(key)
+                return document
+            if self._redis is not None:
+                await self._redis.set(self._redis_key(key), bson.encode(document), ex=self._redis_ttl)
+        self._store(key, document)
+        self._remember(key)
+        return dict(document)
+
+    async def _get_many(self, kind, object_ids, projection, db=None):
+        result = {}
+        missing = []
+        now = time.monotonic()
+        for object_id in object_ids:
+            key = (kind, str(object_id))
+            entry = self._documents.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                self._documents.move_to_end(key)
+                result[key[1]] = dict(entry[1])
+            else:
+                missing.append(key[1])
+        missing = list(dict.fromkeys(missing))
+        if missing:
+            self.misses += len(missing)
+            db = self._db if db is None else db
+            async for document in db[kind].find({"_id": {"$in": [ObjectId(i) for i in missing]}},
+                                                projection=projection):
+                key = (kind, str(document["_id"]))
+                self._store(key, document)
+                self._remember(key)
+                result[key[1]] = dict(document)
+        return result
+
+    def _store(self, key, document):
+        self._documents[key] = (time.monotonic() + self._ttl, document)
+        self._documents.move_to_end(key)
+        while len(self._documents) > self._max_size:
+            self._documents.popitem(last=False)
+
+    def _remember(self, key):
+        self._existing[key] = True
+        self._existing.move_to_end(key)
+        while len(self._existing) > self._max_size:
+            self._existing.popitem(last=False)
+
+    def _redis_key(self, key):
+        return "{}{}:{}".format(self.redis_prefix, key[0], key[1])
+
+
+class MembershipIndex:
+    """
+        Members of each room as a set of 12 byte ObjectId binaries, loaded lazily from the room document and updated
+        when a user joins, so membership checks do not need the database.
+
+        Members are never removed, so a cached positive answer is always right. A negative answer is checked against
+        the database again when the set is older than reload_interval seconds, in case a join was missed.
+    """
+
+    def __init__(self, db, max_rooms=100000, reload_interval=1):
+        self._db = db
+        self._max_rooms = max_rooms
+        self._reload_interval = reload_interval
+        self._rooms = collections.OrderedDict()
+        self._loading = {}
+
+    async def is_member(self, room_id, user_id):
+        key = str(room_id)
+        member = ObjectId(user_id).binary
+        entry = self._rooms.get(key)
+        if entry is not None:
+            self._rooms.move_to_end(key)
+            if member in entry[1]:
+                return True
+            if time.monotonic() - entry[0] < self._reload_interval:
+                return False
+        members = await self._load(key)
+        return members is not None and member in members
+
+    def add(self, room_id, user_id):
+        self.add_many(room_id, [user_id])
+
+    def add_many(self, room_id, user_ids):
+        entry = self._rooms.get(str(room_id))
+        if entry is not None:
+            entry[1].update(ObjectId(user_id).binary for user_id in user_ids)
+
+    async def _load(self, key):
+        # Concurrent misses of a room share one query.
+        future = self._loading.get(key)
+        if future is None:
+            future = self._loading[key] = asyncio.ensure_future(self._fetch(key))
+            future.add_done_callback(lambda _: self._loading.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _fetch(self, key):
+        room = await self._db.room.find_one({"_id": ObjectId(key)}, projection={"members": 1})
+        if room is None:
+            return None
+        # RoomHandler.post stores members as the client sent them, ids may be strings.
+        members = {ObjectId(member).binary for member in room.get("members", []) if ObjectId.is_valid(member)}
+        self._rooms[key] = (time.monotonic(), members)
+        self._rooms.move_to_end(key)
+        while len(self._rooms) > self._max_rooms:
+            self._rooms.popitem(last=False)
+        return members
@@ -0,0 +1,67 @@
+import zlib
+
+from bson.binary import Binary
+from tornado.web import GZipContentEncoding
+
+"""
+Author: Enigma Zhang
+
+Description:
+    This module compresses message content in the database and responses on the wire.
+
+    Text content longer than a threshold is stored zlib compressed with content_encoding set, the messages given to
+    the handlers are left as they are. Readers decompress a message only when it is written out. Responses are gzip
+    compressed when the client accepts it, except partial responses of blob downloads.
+"""
+
+ENCODING = "zlib"
+# Compressed content is only kept if it saves at least this fraction.
+MIN_SAVING = 0.1
+
+
+def pack_content(message, threshold):
+    """
+        Document to store for message, a copy with compressed content if it is text longer than threshold characters.
+    """
+    content = message.get("content")
+    if not threshold or message.get("message_type") != "text" or not isinstance(content, str) or \
+            len(content) <= threshold:
+        return message
+    raw = content.encode("utf-8")
+    compressed = zlib.compress(raw)
+    if len(compressed) > len(raw) * (1 - MIN_SAVING):
+        return message
+    document = dict(message)
+    document["content"] = Binary(compressed)
+    document["content_encoding"] = ENCODING
+    return document
+
+
+def unpack_content(message):
+    """
+        Decompress the content of a stored message in place and return it.
+    """
+    if message.get("content_encoding") == ENCODING:
+        message["content"] = zlib.decompress(message["content"]).decode("utf-8")
+        del message["content_encoding"]
+    return message
+
+
+async def unpacked(cursor):
+    """
+        Iterate the messages of an async cursor with their content decompressed.
+    """
+    async for message in cursor:
+        yield unpack_content(message)
+
+
+class ResponseCompression(GZipContentEncoding):
+    """
+        GZipContentEncoding that leaves partial responses alone, a range of a blob is a range of its stored bytes.
+    """
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        if status_code == 206 or "Content-Range" in headers:
+            self._gzipping = False
+            return status_code, headers, chunk
+        return super().transform_first_chunk(status_code, headers, chunk, finishing)
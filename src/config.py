@@ -0,0 +1,157 @@
+import os
+import sys
+
+from pymongo import read_preferences
+from tornado.options import define, options
+
+"""
+Author: Enigma Zhang
+
+Description:
+    This module defines the options of the app.
+
+    Options are read from, in increasing priority, their defaults, the config file given by --config (a Python file
+    of assignments, see chatroom.cfg.example), CHATROOM_{NAME} environment variables and the command line.
+"""
+
+ENV_PREFIX = "CHATROOM_"
+
+define("config", default="", help="path of the config file")
+define("port", default=9999, help="port to listen on")
+define("workers", default=1, help="number of worker processes sharing the socket, 0 for one per core")
+define("reuse_port", default=False,
+       help="listen with SO_REUSEPORT so that a new server can start before the old one stops")
+define("shutdown_deadline", default=30.0, help="seconds to wait for requests in progress on SIGTERM")
+define("production", default=False, help="turn off debug and autoreload")
+define("metrics", default=True, help="collect metrics and serve them on /metrics")
+define("compress_responses", default=True, help="gzip responses for clients that accept it")
+define("push_compression", default=True, help="permessage-deflate on /api/push for clients that offer it")
+define("message_compress_threshold", default=1024,
+       help="text content longer than this many characters is stored compressed, 0 to store it raw")
+define("metadata_cache_ttl", default=10,
+       help="seconds a worker keeps a user or room document in memory")
+define("metadata_cache_redis_ttl", default=10,
+       help="seconds a user or room document is shared in Redis, a worker may serve it for both TTLs")
+
+define("partitions", default=16, group="partition",
+       help="number of room partitions, fixed for the life of the data")
+define("partition_storage", default=False, group="partition",
+       help="store the messages of partition n in the database chatroom_p{n}, chosen before any message is stored")
+define("partition_routing", default=False, group="partition",
+       help="forward the requests of a room to the worker owning its partition")
+define("internal_port", default=10000, group="partition",
+       help="first port of the worker addresses, worker n listens on internal_port + n for forwarded requests")
+define("advertise_host", default="127.0.0.1", group="partition",
+       help="host the other workers reach this one at")
+define("forward_max_clients", default=1000, group="partition",
+       help="requests a worker forwards to the other workers at once, more wait in a queue")
+define("forward_connect_timeout", default=1.0, group="partition",
+       help="seconds a forwarded request may wait for a free client and a connection before it is answered 503")
+define("forward_request_timeout", default=10.0, group="partition",
+       help="seconds a forwarded request may take before it is answered 503")
+
+define("mongo_uri", default="mongodb://127.0.0.1:27017", group="mongo")
+define("mongo_max_pool_size", default=100, group="mongo", help="connections per server and process")
+define("mongo_min_pool_size", default=0, group="mongo")
+define("mongo_wait_queue_timeout_ms", default=0, group="mongo",
+       help="time a request waits for a free connection, 0 to wait forever")
+define("mongo_server_selection_timeout_ms", default=30000, group="mongo")
+define("mongo_connect_timeout_ms", default=20000, group="mongo")
+define("mongo_socket_timeout_ms", default=0, group="mongo", help="0 for no timeout")
+define("mongo_read_preference", default="primary", group="mongo",
+       help="primary, primaryPreferred, secondary, secondaryPreferred or nearest")
+define("mongo_history_read_preference", default="primary", group="mongo",
+       help="read preference of the message history reads")
+define("mongo_profile_read_preference", default="primary", group="mongo",
+       help="read preference of the user and room reads")
+define("mongo_max_staleness_seconds", default=-1, group="mongo",
+       help="staleness bound of the secondaries used by reads, at least 90, -1 for no bound")
+define("mongo_read_your_writes_seconds", default=120, group="mongo",
+       help="reads of a client that wrote less than this ago go to the primary")
+define("mongo_write_concern", default="1", group="mongo", help="w of the write concern, a number or majority")
+define("mongo_journal", default=False, group="mongo", help="wait for the journal on writes")
+
+define("rate_limit_mode", default="local", group="limits",
+       help="per user rate limits kept in process (local), shared by the workers (redis) or off")
+define("send_rate", default=5.0, group="limits", help="messages per second a user may send")
+define("send_burst", default=20, group="limits")
+define("read_rate", default=20.0, group="limits", help="history reads per second a user may make")
+define("read_burst", default=50, group="limits")
+define("max_in_flight_send", default=1000, group="limits",
+       help="message sends in progress per process before new ones are shed with 503, 0 for no limit")
+define("max_in_flight_read", default=1000, group="limits",
+       help="history reads in progress per process before new ones are shed with 503, 0 for no limit")
+
+define("redis_host", default="127.0.0.1", group="redis")
+define("redis_port", default=6379, group="redis")
+define("redis_db", default=0, group="redis")
+define("redis_max_connections", default=256, group="redis", help="connections of the pool per process")
+define("redis_connect_timeout", default=5.0, group="redis", help="seconds")
+define("redis_stream_timeout", default=5.0, group="redis", help="seconds, 0 for no timeout")
+
+
+def load(args=None, environ=None):
+    """
+        Parse the config file, the environment and the command line into tornado.options.options.
+    """
+    args = sys.argv if args is None else args
+    environ = os.environ if environ is None else environ
+    # First pass to find --config, the command line is parsed again last so that it wins.
+    options.parse_command_line(args, final=False)
+    if options.config:
+        options.parse_config_file(options.config, final=False)
+    env_args = ["--{}={}".format(name, environ[ENV_PREFIX + name.upper()])
+                for name in options if ENV_PREFIX + name.upper() in environ]
+    if env_args:
+        options.parse_command_line(args[:1] + env_args, final=False)
+    options.parse_command_line(args)
+    return options
+
+
+def mongo_client_kwargs():
+    """
+        Keyword arguments of MotorClient from the mongo options.
+    """
+    write_concern = options.mongo_write_concern
+    return {
+        "maxPoolSize": options.mongo_max_pool_size,
+        "minPoolSize": options.mongo_min_pool_size,
+        "waitQueueTimeoutMS": options.mongo_wait_queue_timeout_ms or None,
+        "serverSelectionTimeoutMS": options.mongo_server_selection_timeout_ms,
+        "connectTimeoutMS": options.mongo_connect_timeout_ms,
+        "socketTimeoutMS": options.mongo_socket_timeout_ms or None,
+        "readPreference": options.mongo_read_preference,
+        "w": int(write_concern) if write_concern.isdigit() else write_concern,
+        "journal": options.mongo_journal,
+    }
+
+
+def read_preference(mode):
+    """
+        Read preference of a mode name with the staleness bound of the options.
+    """
+    if mode == "primary":
+        return read_preferences.Primary()
+    classes = {
+        "primaryPreferred": read_preferences.PrimaryPreferred,
+        "secondary": read_preferences.Secondary,
+        "secondaryPreferred": read_preferences.SecondaryPreferred,
+        "nearest": read_preferences.Nearest,
+    }
+    if mode not in classes:
+        raise ValueError("Unknown read preference: {}".format(mode))
+    return classes[mode](max_staleness=options.mongo_max_staleness_seconds)
+
+
+def redis_client_kwargs():
+    """
+        Keyword arguments of aredis.StrictRedis from the redis options.
+    """
+    return {
+        "host": options.redis_host,
+        "port": options.redis_port,
+        "db": options.redis_db,
+        "max_connections": options.redis_max_connections,
+        "connect_timeout": options.redis_connect_timeout,
+        "stream_timeout": options.redis_stream_timeout or None,
+    }
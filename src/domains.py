@@ -5,64 +5,136 @@ Description:
     This module validates models in database of this app.
 """
 
-from cerberus import Validator
+import re
 
-v = Validator(require_all=True)
 
+class FastValidator:
+    """
+        Validator compiled once from a Cerberus style schema, stateless so it is safe to share.
 
-def user_validation(document):
-    schema = {
-        "name":
-            {"type": "string", "regex": "[\u00ff-\uffff0-9a-zA-z]+", "min": 1, "max": 32},
-        "phoneNumber":
-            {"type": "string", "regex": "[0-9]+", "min": 1, "max": 20},
-        "password":
-            {"type": "string", "regex": "[0-9a-zA-z]+", "min": 1, "max": 32},
-        "rooms":
-            {"type": "list"}
+        Supports the rules used by this module with the semantics of Cerberus Validator(require_all=True): every
+        field is required, unknown fields and None values are rejected, regex must match the whole value, min and
+        max only apply to values comparable with them.
+    """
+
+    _types = {
+        "string": (str,),
+        "integer": (int,),
+        "list": (list, tuple),
     }
-    if not v.validate(document, schema):
+
+    def __init__(self, schema):
+        self._fields = {name: self._compile(rules) for name, rules in schema.items()}
+
+    def _compile(self, rules):
+        checks = []
+        if "type" in rules:
+            types = self._types[rules["type"]]
+            checks.append(lambda value: isinstance(value, types))
+        if "allowed" in rules:
+            allowed = frozenset(rules["allowed"])
+            checks.append(lambda value: value in allowed)
+        if "regex" in rules:
+            pattern = rules["regex"]
+            match = re.compile(pattern if pattern.endswith("$") else pattern + "$").match
+            checks.append(lambda value: isinstance(value, str) and match(value) is not None)
+        if "min" in rules:
+            checks.append(self._bound(rules["min"], lambda value, bound: value >= bound))
+        if "max" in rules:
+            checks.append(self._bound(rules["max"], lambda value, bound: value <= bound))
+        return tuple(checks)
+
+    @staticmethod
+    def _bound(bound, compare):
+        def check(value):
+            try:
+                return compare(value, bound)
+            except TypeError:
+                return True
+
+        return check
+
+    def validate(self, document):
+        if not isinstance(document, dict) or len(document) != len(self._fields):
+            return False
+        for name, checks in self._fields.items():
+            value = document.get(name)
+            if value is None:
+                return False
+            for check in checks:
+                if not check(value):
+                    return False
+        return True
+
+
+user_validator = FastValidator({
+    "name":
+        {"type": "string", "regex": "[\u00ff-\uffff0-9a-zA-z]+", "min": 1, "max": 32},
+    "phoneNumber":
+        {"type": "string", "regex": "[0-9]+", "min": 1, "max": 20},
+    "password":
+        {"type": "string", "regex": "[0-9a-zA-z]+", "min": 1, "max": 32},
+    "rooms":
+        {"type": "list"}
+})
+
+room_validator = FastValidator({
+    "name":
+        {"type": "string", "regex": "[\u00ff-\uffff0-9a-zA-z]+", "min": 1, "max": 32},
+    "members":
+        {"type": "list"},
+    "message_num":
+        {"type": "integer"},
+    "room_message_id":
+        {"type": "list"}
+})
+
+message_validator = FastValidator({
+    "userId":
+        {"type": "string", "regex": "^[0-9a-fA-F]{24}$"},
+    "roomId":
+        {"type": "string", "regex": "^[0-9a-fA-F]{24}$"},
+    "message_type":
+        {"type": "string", "allowed": ["text", "image", "file"]},
+    "content":
+        {}
+})
+
+login_validator = FastValidator({
+    "phoneNumber":
+        {"type": "string", "regex": "[0-9]+", "min": 1, "max": 20},
+    "password":
+        {"type": "string", "regex": "[0-9a-zA-z]+", "min": 1, "max": 32}
+})
+
+blob_reference_validator = FastValidator({
+    "blob":
+        {"type": "string", "regex": "^[0-9a-f]{64}$"}
+})
+
+
+def user_validation(document):
+    if not user_validator.validate(document):
         raise ValueError("User argument validation failed!\n" + str(document))
 
 
 def room_validation(document):
-    schema = {
-        "name":
-            {"type": "string", "regex": "[\u00ff-\uffff0-9a-zA-z]+", "min": 1, "max": 32},
-        "members":
-            {"type": "list"},
-        "message_num":
-            {"type": "integer"},
-        "room_message_id":
-            {"type": "list"}
-    }
-    if not v.validate(document, schema):
+    if not room_validator.validate(document):
         raise ValueError("User argument validation failed!\n" + str(document))
 
 
 def message_validation(document):
-    schema = {
-        "userId":
-            {"type": "string", "regex": "^[0-9a-fA-F]{24}$"},
-        "roomId":
-            {"type": "string", "regex": "^[0-9a-fA-F]{24}$"},
-        "message_type":
-            {"type": "string", "allowed": ["text", "image", "file"]},
-        "content":
-            {}
-    }
-
-    if not v.validate(document, schema):
+    if not message_validator.validate(document):
         raise ValueError("User argument validation failed!\n" + str(document))
+    if document["message_type"] in ("image", "file"):
+        # The file is uploaded to /api/blob first, the message only refers to it.
+        content = document["content"]
+        if isinstance(content, dict) and isinstance(content.get("name"), str):
+            content = {k: v for k, v in content.items() if k != "name"}
+        if not blob_reference_validator.validate(content):
+            raise ValueError("User argument validation failed!\n" + str(document))
 
 
 def login_validation(document):
-    schema = {
-        "phoneNumber":
-            {"type": "string", "regex": "[0-9]+", "min": 1, "max": 20},
-        "password":
-            {"type": "string", "regex": "[0-9a-zA-z]+", "min": 1, "max": 32}
-    }
-
-    if not v.validate(document, schema):
+    if not login_validator.validate(document):
         raise ValueError("User argument validation failed!\n" + str(document))
@@ -0,0 +1,162 @@
+import asyncio
+import json
+import uuid
+
+import tornado.log
+
+"""
+Author: Enigma Zhang
+
+Description:
+    This module shares live message delivery between server processes through Redis pub/sub.
+
+    Every committed message is published to the channel of its room. A process only subscribes to the rooms that
+    its own push connections or caches care about, and control events (a user joining a room) go through a control
+    channel every process listens to.
+"""
+
+ROOM_CHANNEL_PREFIX = "chatroom:room:"
+CONTROL_CHANNEL = "chatroom:control"
+
+
+class RedisFanout:
+    """
+        Cross-process fan-out layer on top of the aredis client and the local RoomHub.
+    """
+
+    def __init__(self, my_redis, room_hub, poll_timeout=1):
+        self._redis = my_redis
+        self._hub = room_hub
+        # Subscribe replies confirm that a room channel is live, see is_subscribed.
+        self._pubsub = my_redis.pubsub()
+        self._poll_timeout = poll_timeout
+        # Messages published by this process are delivered locally and skipped when they come back from Redis.
+        self._origin = uuid.uuid4().hex
+        self._control_handlers = {"join": [self._on_join]}
+        self._listeners = [lambda room_id, message, payload: room_hub.deliver(room_id, payload)]
+        self._watched = {}
+        # Subscribe commands of each room not confirmed yet, and rooms whose last subscribe is confirmed.
+        self._pending = {}
+        self._subscribed = set()
+        # Set before start subscribes, rooms watched from then on subscribe themselves.
+        self._started = False
+        self._listener = None
+        room_hub.on_room_added = self.watch
+        room_hub.on_room_removed = self.unwatch
+
+    async def start(self):
+        self._started = True
+        rooms = [ROOM_CHANNEL_PREFIX + room_id for room_id in self._watched]
+        for room_id in self._watched:
+            self._pending[room_id] = self._pending.get(room_id, 0) + 1
+        await self._pubsub.subscribe(CONTROL_CHANNEL)
+        if rooms:
+            await self._pubsub.subscribe(*rooms)
+        self._listener = asyncio.ensure_future(self._listen())
+
+    async def stop(self):
+        self._started = False
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        await self._pubsub.unsubscribe()
+
+    def add_control_handler(self, event_type, handler):
+        self._control_handlers.setdefault(event_type, []).append(handler)
+
+    def add_listener(self, listener):
+        """
+            listener(room_id, message, payload) is called for every message of a watched room. message is None for
+            messages of other processes, payload is the JSON encoding of the message.
+        """
+        self._listeners.append(listener)
+
+    def watch(self, room_id):
+        self._watched[room_id] = self._watched.get(room_id, 0) + 1
+        if self._watched[room_id] == 1 and self._started:
+            self._pending[room_id] = self._pending.get(room_id, 0) + 1
+            asyncio.ensure_future(self._pubsub.subscribe(ROOM_CHANNEL_PREFIX + room_id))
+
+    def unwatch(self, room_id):
+        self._watched[room_id] -= 1
+        if self._watched[room_id] == 0:
+            del self._watched[room_id]
+            self._subscribed.discard(room_id)
+            if self._started:
+                asyncio.ensure_future(self._pubsub.unsubscribe(ROOM_CHANNEL_PREFIX + room_id))
+
+    def is_subscribed(self, room_id):
+        """
+            Whether Redis confirmed the subscription to the room, every message published from then on is received.
+        """
+        return room_id in self._subscribed
+
+    def _on_subscribed(self, channel):
+        if not channel.startswith(ROOM_CHANNEL_PREFIX):
+            return
+        room_id = channel[len(ROOM_CHANNEL_PREFIX):]
+        pending = self._pending.get(room_id, 0) - 1
+        if pending > 0:
+            # A later subscribe of the room, after an unsubscribe, is not confirmed yet.
+            self._pending[room_id] = pending
+            return
+        self._pending.pop(room_id, None)
+        if room_id in self._watched:
+            self._subscribed.add(room_id)
+
+    async def publish(self, room_id, message):
+        """
+            Deliver a committed message to local listeners and to every other process subscribed to the room.
+        """
+        payload = json.dumps(message)
+        for listener in self._listeners:
+            listener(room_id, message, payload)
+        await self._redis.publish(ROOM_CHANNEL_PREFIX + room_id, self._origin + " " + payload)
+
+    async def publish_control(self, event_type, **event):
+        event["type"] = event_type
+        await self._redis.publish(CONTROL_CHANNEL, self._origin + " " + json.dumps(event))
+
+    async def add_member(self, room_id, uid):
+        """
+            Subscribe the open connections of user uid, on any process, to a room it has just joined.
+        """
+        await self.add_members(room_id, [uid])
+
+    async def add_members(self, room_id, uids):
+        for uid in uids:
+            self._hub.add_member(room_id, uid)
+        await self.publish_control("join", room_id=room_id, uids=uids)
+
+    def _on_join(self, event):
+        for uid in event["uids"]:
+            self._hub.add_member(event["room_id"], uid)
+
+    async def _listen(self):
+        while True:
+            try:
+                item = await self._pubsub.get_message(timeout=self._poll_timeout)
+                if item is None:
+                    continue
+                if item["type"] == "subscribe":
+                    self._on_subscribed(item["channel"].decode())
+                    continue
+                if item["type"] != "message":
+                    continue
+                origin, payload = item["data"].decode().split(" ", 1)
+                if origin == self._origin:
+                    continue
+                channel = item["channel"].decode()
+                if channel == CONTROL_CHANNEL:
+                    event = json.loads(payload)
+                    for handler in self._control_handlers.get(event["type"], ()):
+                        handler(event)
+                else:
+                    room_id = channel[len(ROOM_CHANNEL_PREFIX):]
+                    for listener in self._listeners:
+                        listener(room_id, None, payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                tornado.log.app_log.warning("Fan-out listener error: ", exc_info=True)
+                await asyncio.sleep(self._poll_timeout)
@@ -1,7 +1,8 @@
 import asyncio
 import datetime
 import json
-import math
+import time
+import urllib.parse
 from abc import ABC
 from typing import Optional, Awaitable, Any
 import os
@@ -11,16 +12,37 @@ import bson
 import jwt
 import motor
 import pymongo
+import tornado.httpserver
 import tornado.ioloop
 import tornado.log
+import tornado.netutil
+import tornado.options
+import tornado.process
 import tornado.web
 import tornado.autoreload
 from bson.objectid import ObjectId
 from tornado import httputil
 from tornado.web import Application
 
+import config
 import domains
-from tools import objectIdToStr, Encryption, token_generate, auth_with_token
+from fanout import RedisFanout
+from partition import PARTITIONED_COLLECTIONS, Partitions, PartitionRouter
+from metrics import AppMetrics, InstrumentedDatabase, InstrumentedRedis, MetricsHandler, MongoPoolListener, \
+    register_pool_gauges
+from push import RoomHub, MessagePushHandler
+from ratelimit import ConcurrencyLimiter, make_rate_limiter
+from archive import ArchiveJob, newest_first, read_archived, unpack_bucket
+from batcher import MessageBatcher
+from blobs import BlobStore, BlobUploadHandler, BlobHandler
+from cache import RecentMessageCache, MetadataCache, MembershipIndex
+from compression import ResponseCompression, unpack_content
+from schema import ensure_indexes
+from summary import RoomSummary
+from serialization import dumps, write_list
+from shutdown import GracefulShutdown, RequestCounter
+from store import contiguous_from
+from tools import objectIdToStr, token_generate, auth_with_token, TokenCache, PasswordPool, PoolSaturated
 
 """
 Author: Enigma Zhang
@@ -31,18 +53,127 @@ Description:
 
 
 class BaseHandler(tornado.web.RequestHandler, ABC):
+    # Name of the limits of the handler in the concurrency_limits and rate_limits settings.
+    limits = None
+    _metrics_start = None
+    _request_stats = None
+    _concurrency_limiter = None
+    _counted = False
 
     def prepare(self) -> Optional[Awaitable[None]]:
+        self.settings["requests"].acquire()
+        self._counted = True
+        if self.settings["draining"]:
+            # Shutting down, the client must reconnect for its next request. Tornado has no public way to close a
+            # keep-alive connection after the response.
+            connection = self.request.connection
+            if hasattr(connection, "_disconnect_on_finish"):
+                connection._disconnect_on_finish = True
+        metrics = self.settings["metrics"]
+        if metrics is not None:
+            self._metrics_start = time.perf_counter()
+            self._request_stats = metrics.start_request()
         self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        if self.limits is not None and self.request.method != "OPTIONS":
+            limiter = self.settings["concurrency_limits"][self.limits]
+            if not limiter.acquire():
+                # Shed before touching the database.
+                self.set_status(503)
+                self.set_header("Retry-After", "1")
+                self.finish()
+                return
+            self._concurrency_limiter = limiter
         if "Authorization" in self.request.headers.keys() and self.request.headers["Authorization"]:
             if self.request.headers["Authorization"].startswith("Bearer"):
                 self.request.headers["Authorization"] = self.request.headers["Authorization"].split()[1].strip()
         return super().prepare()
 
+    def on_finish(self) -> None:
+        if self._counted:
+            self.settings["requests"].release()
+            self._counted = False
+        if self._concurrency_limiter is not None:
+            self._concurrency_limiter.release()
+            self._concurrency_limiter = None
+        if self._request_stats is not None:
+            self.settings["metrics"].finish_request(self, self._metrics_start, self._request_stats)
+
+    async def rate_limited(self, uid):
+        """
+            Take a token of the rate limit of the handler for uid, answer 429 and return True if there is none.
+        """
+        limiter = self.settings["rate_limits"].get(self.limits)
+        if limiter is None:
+            return False
+        wait = await limiter.allow(uid)
+        if not wait:
+            return False
+        self.set_status(429)
+        self.set_header("Retry-After", str(max(1, int(wait + 0.999))))
+        return True
+
+    def wrote(self):
+        """
+            Remember that this client just wrote, in a cookie and a header that clients without cookies send back.
+        """
+        now = "{:.3f}".format(time.time())
+        self.set_cookie("last_write", now)
+        self.set_header("X-Last-Write", now)
+
+    def read_db(self, kind):
+        """
+            Database to read history or profile documents from, kind is "history" or "profile". They may be read
+            from secondaries, except by a client that wrote recently so that it reads its own writes.
+        """
+        last_write = self.get_cookie("last_write") or self.request.headers.get("X-Last-Write")
+        try:
+            if time.time() - float(last_write) < self.settings["read_your_writes_seconds"]:
+                return self.settings["db"]
+        except (TypeError, ValueError):
+            pass
+        return self.settings[kind + "_db"]
+
+    def bypass_cache(self, db):
+        """
+            Whether profile reads from db must skip the metadata cache. Only when reading its own writes while profile
+            reads go to secondaries: entries may have been filled from a lagging secondary after the write. With
+            primary reads, the writes already invalidate the entries they change.
+        """
+        return db is self.settings["db"] and self.settings["profile_reads_secondary"]
+
+    def message_db(self, room_id, db):
+        """
+            Database of the messages of a room, db is the result of read_db("history") or settings["db"].
+        """
+        kind = "db" if db is self.settings["db"] else "history_db"
+        return self.settings["partitions"].database(room_id, kind)
+
+    async def forward_to_owner(self, room_id=None):
+        """
+            Forward the request to the worker owning the partition of room_id, by default the roomId of the JSON
+            body. Returns True if the owner answered, then the handler must return.
+        """
+        router = self.settings["partition_router"]
+        if router is None:
+            return False
+        if room_id is None:
+            try:
+                body = json.loads(self.request.body)
+            except ValueError:
+                return False
+            room_id = body.get("roomId") if isinstance(body, dict) else None
+        return await router.forward(self, room_id)
+
+    async def authorized(self):
+        """
+            Check the token in the Authorization header, return its uid or None.
+        """
+        return await auth_with_token(self.settings["my_redis"], self.request.headers.get("Authorization", ""),
+                                     self.settings["token_cache"])
+
     async def get(self, *args, **kwargs):
         try:
             self.set_header('Content-Type', 'text/html; charset=UTF-8')
-            tornado.log.app_log.warning(self._headers)
             self.set_status(200)
             await self.render("static/main.html")
             return
@@ -68,19 +199,16 @@ class UserHandler(BaseHandler, ABC):
         """
         try:
             if userId:
-                db = self.settings["db"]
-                user_repo = db.user
-                result = await user_repo.find_one({"_id": ObjectId(userId)})
+                db = self.read_db("profile")
+                result = await self.settings["metadata_cache"].get_user(ObjectId(userId), db,
+                                                                        fresh=self.bypass_cache(db))
                 if result is None:
                     raise ValueError("User id not found")
-                objectIdToStr(result)
-                del result["password"]
-                result["rooms"] = list(map(str, result["rooms"]))
-                if not await auth_with_token(self.settings["my_redis"], self.request.headers["Authorization"]):
+                if not await self.authorized():
                     del result["phoneNumber"]
                     del result["rooms"]
                 self.set_status(200)
-                self.write(json.dumps(result))
+                self.write(dumps(result))
                 return
         except asyncio.CancelledError:
             raise
@@ -98,17 +226,26 @@ class UserHandler(BaseHandler, ABC):
         Validation:
         function user_validation
         phoneNumber is unique
+        rooms is ignored, a new user has no room
         """
         try:
             user = json.loads(self.request.body)
             domains.user_validation(user)
+            # Rooms are only added by joining them.
+            user["rooms"] = []
             db = self.settings["db"]
             user_repo = db.user
             if await user_repo.count_documents({"phoneNumber": user["phoneNumber"]}) > 0:
                 raise ValueError("User already registered")
-            user["password"] = Encryption.encryption(user["password"])
-            await user_repo.insert_one(user)
+            user["password"] = await self.settings["password_pool"].encryption(user["password"])
+            try:
+                await user_repo.insert_one(user)
+            except pymongo.errors.DuplicateKeyError:
+                # Registered concurrently, phoneNumber is unique in schema.py.
+                raise ValueError("User already registered")
 
+            self.settings["metadata_cache"].put("user", user)
+            self.wrote()
             objectIdToStr(user)
             del user["password"]
             self.set_status(201)
@@ -116,6 +253,10 @@ class UserHandler(BaseHandler, ABC):
             return
         except asyncio.CancelledError:
             raise
+        except PoolSaturated:
+            tornado.log.app_log.warning("Password pool saturated, registration refused.")
+            self.set_status(503)
+            return
         except ValueError:
             tornado.log.app_log.warning("API using error: ", exc_info=True)
 
@@ -138,19 +279,17 @@ class UserPhoneNumberHandler(BaseHandler, ABC):
         """
         try:
             if phoneNumber:
-                db = self.settings["db"]
+                db = self.read_db("profile")
                 user_repo = db.user
                 result = await user_repo.find_one({"phoneNumber": phoneNumber})
                 if result is None:
                     raise ValueError("User id not found")
-                objectIdToStr(result)
-                result["rooms"] = list(map(str, result["rooms"]))
                 del result["password"]
-                if not await auth_with_token(self.settings["my_redis"], self.request.headers["Authorization"]):
+                if not await self.authorized():
                     del result["phoneNumber"]
                     del result["rooms"]
                 self.set_status(200)
-                self.write(json.dumps(result))
+                self.write(dumps(result))
                 return
         except asyncio.CancelledError:
             raise
@@ -177,17 +316,15 @@ class RoomHandler(BaseHandler, ABC):
         """
         try:
             if roomId:
-                db = self.settings["db"]
-                room_repo = db.room
-                result = await room_repo.find_one({"_id": ObjectId(roomId)})
+                # message_num and update_time may be up to metadata_cache_ttl + metadata_cache_redis_ttl seconds
+                # old: a copy read from Redis is kept in memory for another metadata_cache_ttl.
+                db = self.read_db("profile")
+                result = await self.settings["metadata_cache"].get_room(ObjectId(roomId), db,
+                                                                        fresh=self.bypass_cache(db))
                 if result is None:
                     raise ValueError("Room id not found")
-                objectIdToStr(result)
-                result["members"] = list(map(str, result["members"]))
-                result["room_message_id"] = list(map(str, result["room_message_id"]))
-                tornado.log.app_log.warning(result)
                 self.set_status(200)
-                self.write(json.dumps(result))
+                self.write(dumps(result))
                 return
         except asyncio.CancelledError:
             raise
@@ -210,6 +347,8 @@ class RoomHandler(BaseHandler, ABC):
             db = self.settings["db"]
             room_repo = db.room
             await room_repo.insert_one(room)
+            self.settings["metadata_cache"].put("room", room)
+            self.wrote()
             objectIdToStr(room)
             self.set_status(201)
             self.write(json.dumps(room))
@@ -241,7 +380,7 @@ class RoomChangeHandler(BaseHandler, ABC):
         userId is not in members list of room item
         """
         try:
-            if not await auth_with_token(self.settings["my_redis"], self.request.headers["Authorization"]):
+            if not await self.authorized():
                 tornado.log.app_log.warning(self.request.headers["Authorization"])
                 uid = jwt.api_jwt.decode(self.request.headers["Authorization"], key="secret",
                                          algorithms="HS256",
@@ -256,16 +395,23 @@ class RoomChangeHandler(BaseHandler, ABC):
             roomId = ObjectId(roomId)
             userId = ObjectId(userId)
             db = self.settings["db"]
+            metadata_cache = self.settings["metadata_cache"]
             room_repo = db.room
             user_repo = db.user
-            room_item_num = await room_repo.count_documents({"_id": roomId})
-            user_item_num = await user_repo.count_documents({"_id": userId})
-            if room_item_num == 0 or user_item_num == 0:
+            if not (await metadata_cache.room_exists(roomId) and await metadata_cache.user_exists(userId)):
                 raise ValueError("Id does not exist.")
-            if await room_repo.count_documents({"_id": roomId, "members": userId}) > 0:
+            # Only matches if the user is not a member yet, so concurrent joins cannot add it twice.
+            result = await room_repo.update_one({"_id": roomId, "members": {"$ne": userId}},
+                                                {"$push": {"members": userId}})
+            if result.matched_count == 0:
                 raise ValueError("User already in room")
-            await room_repo.update_one({"_id": roomId}, {"$push": {"members": userId}})
             await user_repo.update_one({"_id": userId}, {"$push": {"rooms": roomId}})
+            await metadata_cache.invalidate("room", roomId)
+            await metadata_cache.invalidate("user", userId)
+            self.settings["membership_index"].add(roomId, userId)
+            await self.settings["fanout"].add_member(str(roomId), str(userId))
+            await self.settings["room_summary"].joined(roomId, [userId])
+            self.wrote()
             self.set_status(201)
             return
         except asyncio.CancelledError:
@@ -276,11 +422,128 @@ class RoomChangeHandler(BaseHandler, ABC):
         self.set_status(403)
 
 
+class RoomMembersHandler(BaseHandler, ABC):
+    """
+    Handle /api/room/{id}/users
+    """
+
+    async def post(self, roomId, *args, **kwargs):
+        """
+        :param roomId:
+        :param args:
+        :param kwargs:
+        :return: {"results": [{"userId": id, "result": "joined", "member", "not_found" or "invalid"}]}, 200;
+        None, 403
+        Validation:
+        body is {"userIds": [id, ...]} with at most max_bulk_ids ids
+        roomId exists in db room
+        Adds every user of userIds that exists and is not a member yet to the room, with four Mongo calls whatever
+        the number of users (room, users, room update, one bulk write of the users), then the cache and Redis updates.
+        """
+        try:
+            if not await self.authorized():
+                self.set_status(401)
+                return
+            body = json.loads(self.request.body)
+            user_ids = body.get("userIds") if isinstance(body, dict) else None
+            if not isinstance(user_ids, list) or not 0 < len(user_ids) <= self.settings["max_bulk_ids"]:
+                raise ValueError("Wrong userIds.")
+            roomId = ObjectId(roomId)
+            db = self.settings["db"]
+            room = await db.room.find_one({"_id": roomId}, projection={"members": 1})
+            if room is None:
+                raise ValueError("Room id not exists.")
+            valid = [ObjectId(i) for i in user_ids if isinstance(i, str) and ObjectId.is_valid(i)]
+            existing = {user["_id"] async for user in db.user.find({"_id": {"$in": valid}}, projection={"_id": 1})}
+            members = set(room.get("members", []))
+            results = {}
+            joining = []
+            for user_id in valid:
+                if str(user_id) in results:
+                    continue
+                if user_id not in existing:
+                    results[str(user_id)] = "not_found"
+                elif user_id in members:
+                    results[str(user_id)] = "member"
+                else:
+                    results[str(user_id)] = "joined"
+                    joining.append(user_id)
+            if joining:
+                await db.room.update_one({"_id": roomId}, {"$addToSet": {"members": {"$each": joining}}})
+                await db.user.bulk_write([pymongo.UpdateOne({"_id": user_id}, {"$addToSet": {"rooms": roomId}})
+                                          for user_id in joining], ordered=False)
+                metadata_cache = self.settings["metadata_cache"]
+                await metadata_cache.invalidate("room", roomId)
+                await metadata_cache.invalidate_many("user", joining)
+                self.settings["membership_index"].add_many(roomId, joining)
+                await self.settings["fanout"].add_members(str(roomId), [str(user_id) for user_id in joining])
+                await self.settings["room_summary"].joined(roomId, joining)
+                self.wrote()
+            report = []
+            for user_id in user_ids:
+                if isinstance(user_id, str) and ObjectId.is_valid(user_id):
+                    report.append({"userId": user_id, "result": results[str(ObjectId(user_id))]})
+                else:
+                    report.append({"userId": user_id, "result": "invalid"})
+            self.set_status(200)
+            self.write(json.dumps({"results": report}))
+            return
+        except asyncio.CancelledError:
+            raise
+        except (bson.errors.InvalidId, ValueError):
+            tornado.log.app_log.warning("API using error: ", exc_info=True)
+
+        self.set_status(403)
+
+
+class UsersHandler(BaseHandler, ABC):
+    """
+    Handle /api/users?ids={id},{id}...
+    """
+
+    async def get(self, *args, **kwargs):
+        """
+        :param args:
+        :param kwargs:
+        :return: list of user domain without password in the order of ids, unknown ids left out, 200; None, 404
+        Like UserHandler.get, phoneNumber and rooms are only returned with a valid token.
+        Validation:
+        at most max_bulk_ids ids
+        """
+        try:
+            ids = [i for i in self.get_query_argument("ids", "").split(",") if i]
+            if not 0 < len(ids) <= self.settings["max_bulk_ids"]:
+                raise ValueError("Wrong ids.")
+            user_ids = [ObjectId(i) for i in ids]
+            users = await self.settings["metadata_cache"].get_users(user_ids, self.read_db("profile"))
+            authorized = await self.authorized()
+            result = []
+            for user_id in dict.fromkeys(str(i) for i in user_ids):
+                user = users.get(user_id)
+                if user is None:
+                    continue
+                if not authorized:
+                    user.pop("phoneNumber", None)
+                    user.pop("rooms", None)
+                result.append(user)
+            self.set_status(200)
+            self.write(dumps(result))
+            return
+        except asyncio.CancelledError:
+            raise
+        except (bson.errors.InvalidId, ValueError):
+            tornado.log.app_log.warning("API using error: ", exc_info=True)
+
+        self.set_status(404)
+
+
 class MessageHandler(BaseHandler, ABC):
     """
     Handle /api/message and /api/message/{id}
     """
 
+    limits = "send"
+
     def __init__(self, application: "Application", request: httputil.HTTPServerRequest, **kwargs: Any) -> None:
         super().__init__(application, request, **kwargs)
 
@@ -291,59 +554,46 @@ class MessageHandler(BaseHandler, ABC):
         :return: None, 201; None, 403
         Validation:
         function message_validation
-        userId and roomId exist in db user and room
+        userId is the user of the token
+        userId is a member of roomId
+        content of image and file messages refers to an uploaded blob
         """
         try:
-            if not await auth_with_token(self.settings["my_redis"], self.request.headers["Authorization"]):
+            if await self.forward_to_owner():
+                return
+            uid = await self.authorized()
+            if not uid:
                 self.set_status(401)
                 return
+            if await self.rate_limited(uid):
+                return
             message = json.loads(self.request.body)
             domains.message_validation(message)
-            db = self.settings["db"]
-            client = self.settings["client"]
-            message_repo = db.message
-            user_repo = db.user
-            room_repo = db.room
             userId = ObjectId(message["userId"])
             roomId = ObjectId(message["roomId"])
-            room_message_repo = db.room_message
-            if await user_repo.count_documents({"_id": userId}) == 0 or \
-                    await room_repo.count_documents({"_id": roomId}) == 0:
-                raise ValueError("User or room not exists")
-            update_time = int(datetime.datetime.utcnow().timestamp())
-            message["create_time"] = update_time
-            async with await client.start_session() as s:
-                async with s.start_transaction():
-                    result = await message_repo.insert_one(message, session=s)
-                    messageId = result.inserted_id
-                    room_repo.update_one({"_id": roomId},
-                                         {"$set": {"update_time": update_time}, "$inc": {"message_num": 1}},
-                                         session=s)
-                    room_message_id_list = (room_repo.find_one({"_id": roomId}))["room_message_id"]
-                    if len(room_message_id_list) > 0:
-                        # If message already sent in this room
-                        room_message_id = room_message_id_list[-1]
-                        room_message_item = room_message_repo.find_one({"_id": room_message_id}, session=s)
-                        if len(room_message_item["messages"]) >= self.settings["message_num_per_document"]:
-                            # If message exceeds the max message num of one room message document
-                            new_room_message_id = (room_message_repo.insert_one(
-                                {"messages": [messageId]}, session=s)).inserted_id
-                            room_repo.update_one({"_id": roomId},
-                                                 {"$push": {"room_message_id": new_room_message_id}}, session=s)
-                        else:
-                            room_message_repo.update_one({"_id": room_message_id},
-                                                         {"$push": {"messages": messageId}}, session=s)
-                    else:
-                        new_room_message_id = (room_message_repo.insert_one(
-                            {"room_id": roomId, "messages": [messageId]}, session=s)).inserted_id
-                        room_repo.update_one({"_id": roomId}, {"$push": {"room_message_id": new_room_message_id}},
-                                             session=s)
+            if message["userId"] != uid:
+                raise ValueError("Message is not sent by the user of the token")
+            # Members exist, a room has only members that existed when they joined.
+            if not await self.settings["membership_index"].is_member(roomId, userId):
+                raise ValueError("User is not a member of the room")
+            if message["message_type"] in ("image", "file"):
+                blob = await self.settings["db"].blob.find_one({"_id": message["content"]["blob"]})
+                if blob is None:
+                    raise ValueError("Blob not uploaded")
+                message["content"]["size"] = blob["size"]
+                message["content"]["content_type"] = blob["content_type"]
+            message["create_time"] = int(datetime.datetime.utcnow().timestamp())
+            # Raises ValueError if the room does not exist.
+            await self.settings["message_batcher"].append(message)
             objectIdToStr(message)
+            await self.settings["room_summary"].on_message(message, sender=uid)
+            await self.settings["fanout"].publish(str(roomId), message)
+            self.wrote()
             self.set_status(201)
             return
         except asyncio.CancelledError:
             raise
-        except ValueError:
+        except (bson.errors.InvalidId, ValueError):
             tornado.log.app_log.warning("API using error: ", exc_info=True)
 
         self.set_status(403)
@@ -354,6 +604,8 @@ class RoomMessageHandler(BaseHandler, ABC):
     Handle /api/room/{roomId}/latest/{update-time}/{message-num}
     """
 
+    limits = "read"
+
     async def get(self, roomId=None, update_time=None, message_num=None, *args, **kwargs):
         """
         :param update_time:
@@ -361,25 +613,42 @@ class RoomMessageHandler(BaseHandler, ABC):
         :param message_num:
         :param args:
         :param kwargs:
-        :return: list of domain message, 200; None, 404
+        :return: list of domain message, 200; None, 403 if the user of the token is not a member of the room; None, 404
         """
         max_num = self.settings["max_message_num_per_get"]
         try:
-            if not await auth_with_token(self.settings["my_redis"], self.request.headers["Authorization"]):
+            if await self.forward_to_owner(roomId):
+                return
+            uid = await self.authorized()
+            if not uid:
                 self.set_status(401)
                 return
+            if await self.rate_limited(uid):
+                return
             if roomId and message_num and update_time is None:
                 raise ValueError("One of argument is None.")
-            db = self.settings["db"]
+            if not await self.settings["membership_index"].is_member(ObjectId(roomId), uid):
+                self.set_status(403)
+                return
+            cached = self.settings["recent_cache"].latest(roomId, int(message_num), max_num)
+            if cached is not None:
+                self.set_status(200)
+                self.write(dumps(cached))
+                return
+            db = self.read_db("history")
+            # A secondary may miss messages published before the subscription, only primary reads fill the cache.
+            live = self.settings["recent_cache"].live(roomId) and \
+                (db is self.settings["db"] or not self.settings["history_reads_secondary"])
             room_repo = db.room
-            message_repo = db.message
-            room_message_repo = db.room_message
+            message_db = self.message_db(roomId, db)
+            message_repo = message_db.message
+            room_message_repo = message_db.room_message
             room_item = await room_repo.find_one({"_id": ObjectId(roomId)})
             message_num_per_document = self.settings["message_num_per_document"]
             if room_item is None:
                 raise ValueError("Room id not exists.")
             room_message_list = room_item["room_message_id"]
-            new_update_time = int(room_item["update_time"])
+            new_update_time = int(room_item.get("update_time", 0))
             new_message_num = int(room_item["message_num"])
             update_time = int(update_time)
             message_num = int(message_num)
@@ -394,18 +663,165 @@ class RoomMessageHandler(BaseHandler, ABC):
                 self.set_status(200)
                 self.write(json.dumps([]))
                 return
-            room_message_num = math.ceil(message_num / message_num_per_document)
-            room_message_fetch_list = room_message_list[-room_message_num:]
-            room_message_fetch_list = list(map(ObjectId, room_message_fetch_list))
+            # Bucket index of a message is (seq - 1) // message_num_per_document, see store.py.
+            first_index = max(0, (new_message_num - message_num) // message_num_per_document)
+            room_message_fetch_list = [i for i in room_message_list[first_index:] if i is not None]
             message_id = []
+            archived = []
             async for room_message_item in room_message_repo.find({"_id": {"$in": room_message_fetch_list}}):
-                message_id.extend(room_message_item["messages"])
-            cursor = message_repo.find({"_id": {"$in": message_id}}).sort("_id", pymongo.DESCENDING)
-            messages = await cursor.to_list(length=message_num)
-            for i in messages:
-                i["_id"] = str(i["_id"])
+                if room_message_item.get("archived"):
+                    # Archived history is stored in the bucket itself.
+                    archived.extend(unpack_bucket(room_message_item))
+                else:
+                    message_id.extend(room_message_item["messages"])
+            cursor = message_repo.find({"_id": {"$in": message_id}}).sort("seq", pymongo.DESCENDING)
+            cursor = cursor.limit(message_num).batch_size(self.settings["response_batch_size"])
+            messages = []
+            self.set_status(200)
+            await write_list(self, newest_first(cursor if message_id else None, archived, message_num),
+                             self.settings["response_batch_size"], messages.append)
+            if live and messages and len(messages) == message_num and messages[0].get("seq") == new_message_num and \
+                    messages[-1].get("seq") == new_message_num - message_num + 1:
+                # The latest messages of the room without gap, the next reads can be served from memory.
+                self.settings["recent_cache"].fill(roomId, messages[::-1])
+            return
+        except asyncio.CancelledError:
+            raise
+        except (bson.errors.InvalidId, ValueError):
+            tornado.log.app_log.warning("API using error: ", exc_info=True)
+
+        self.set_status(404)
+
+
+class MessagePageHandler(BaseHandler, ABC):
+    """
+    Handle /api/room/{roomId}/messages?since_seq={seq}&before_seq={seq}&limit={limit}
+    """
+
+    limits = "read"
+
+    async def get(self, roomId=None, *args, **kwargs):
+        """
+        :param roomId:
+        :param args:
+        :param kwargs:
+        :return: list of domain message, 200; None, 403 if the user of the token is not a member of the room; None, 404
+        Every message has seq, its position in the room starting from 1.
+        since_seq: messages after since_seq, oldest first, to download exactly what the client is missing. Only
+        messages of contiguous seq are returned, the list stops before a message still being inserted.
+        before_seq: messages before before_seq, newest first, to scroll back through the history.
+        Neither: the latest messages, newest first.
+        At most limit messages are returned, limit is capped by max_message_num_per_get.
+        """
+        try:
+            if await self.forward_to_owner(roomId):
+                return
+            uid = await self.authorized()
+            if not uid:
+                self.set_status(401)
+                return
+            if await self.rate_limited(uid):
+                return
+            if not await self.settings["membership_index"].is_member(ObjectId(roomId), uid):
+                self.set_status(403)
+                return
+            since_seq = self.get_query_argument("since_seq", None)
+            before_seq = self.get_query_argument("before_seq", None)
+            limit = int(self.get_query_argument("limit", self.settings["message_page_size"]))
+            if limit <= 0:
+                raise ValueError("Wrong limit.")
+            limit = min(limit, self.settings["max_message_num_per_get"])
+            seq_range = {}
+            if since_seq is not None:
+                since_seq = int(since_seq)
+                seq_range["$gt"] = since_seq
+            if before_seq is not None:
+                before_seq = int(before_seq)
+                seq_range["$lt"] = before_seq
+            if since_seq is not None and before_seq is None:
+                cached = self.settings["recent_cache"].since(roomId, since_seq, limit)
+                if cached is not None:
+                    self.set_status(200)
+                    self.write(dumps(cached))
+                    return
+            query = {"roomId": roomId}
+            if seq_range:
+                query["seq"] = seq_range
+            order = pymongo.ASCENDING if since_seq is not None else pymongo.DESCENDING
+            history_db = self.read_db("history")
+            db = self.message_db(roomId, history_db)
+            cursor = db.message.find(query).sort("seq", order).limit(limit)
+            if seq_range:
+                if since_seq is not None:
+                    first_seq = since_seq + 1
+                    last_seq = since_seq + limit if before_seq is None else min(before_seq - 1, since_seq + limit)
+                else:
+                    first_seq, last_seq = max(1, before_seq - limit), before_seq - 1
+                messages, archived = await asyncio.gather(
+                    cursor.to_list(length=limit),
+                    read_archived(db, roomId, first_seq, last_seq,
+                                  self.settings["message_num_per_document"]))
+            else:
+                room, messages = await asyncio.gather(
+                    history_db.room.find_one({"_id": ObjectId(roomId)}, projection={"message_num": 1}),
+                    cursor.to_list(length=limit))
+                if room is None:
+                    raise ValueError("Room id not exists.")
+                archived = []
+                if len(messages) < limit:
+                    # The latest buckets of an idle room are archived too.
+                    message_num = int(room.get("message_num", 0))
+                    archived = await read_archived(db, roomId, max(1, message_num - limit + 1), message_num,
+                                                   self.settings["message_num_per_document"])
+            self.set_status(200)
+            if archived:
+                messages = list({m["seq"]: m for m in messages + archived}.values())
+                messages.sort(key=lambda m: m["seq"], reverse=order == pymongo.DESCENDING)
+                messages = messages[:limit]
+            if since_seq is not None:
+                # The client asks again from the last seq it got, it must not skip a message still being inserted.
+                messages = contiguous_from(messages, since_seq + 1, self.settings["seq_gap_timeout"])
+            self.write(dumps([unpack_content(m) for m in messages]))
+            return
+        except asyncio.CancelledError:
+            raise
+        except (bson.errors.InvalidId, ValueError):
+            tornado.log.app_log.warning("API using error: ", exc_info=True)
+
+        self.set_status(404)
+
+
+class RoomSummaryHandler(BaseHandler, ABC):
+    """
+    Handle /api/summary
+    """
+
+    async def get(self, *args, **kwargs):
+        """
+        :param args:
+        :param kwargs:
+        :return: list of room summary of the user of the token, most recently active first, 200; None, 404
+        A room summary is roomId, name, message_num, update_time, last_message (userId, message_type, content preview,
+        seq, create_time, or None) and unread, the number of messages after the read cursor of the user.
+        """
+        try:
+            uid = await self.authorized()
+            if not uid:
+                self.set_status(401)
+                return
+            db = self.read_db("profile")
+            metadata_cache = self.settings["metadata_cache"]
+            user = await metadata_cache.get_user(ObjectId(uid), db, fresh=self.bypass_cache(db))
+            if user is None:
+                raise ValueError("User id not found")
+            rooms = await metadata_cache.get_rooms(user.get("rooms", []), db)
+            rooms = [rooms[str(room_id)] for room_id in user.get("rooms", []) if str(room_id) in rooms]
+            # user.rooms of users registered before it was ignored may hold rooms they never joined.
+            membership_index = self.settings["membership_index"]
+            members = await asyncio.gather(*[membership_index.is_member(room["_id"], uid) for room in rooms])
+            rooms = [room for room, member in zip(rooms, members) if member]
             self.set_status(200)
-            self.write(json.dumps(messages))
+            self.write(dumps(await self.settings["room_summary"].summaries(uid, rooms)))
             return
         except asyncio.CancelledError:
             raise
@@ -415,6 +831,46 @@ class RoomMessageHandler(BaseHandler, ABC):
         self.set_status(404)
 
 
+class RoomReadHandler(BaseHandler, ABC):
+    """
+    Handle /api/room/{roomId}/read
+    """
+
+    async def post(self, roomId, *args, **kwargs):
+        """
+        :param roomId:
+        :param args:
+        :param kwargs:
+        :return: {"seq": read cursor}, 200; None, 403
+        Validation:
+        body is {"seq": seq of the last message read}
+        the user of the token is a member of the room
+        Read cursors only move forward and never past the last message of the room.
+        """
+        try:
+            uid = await self.authorized()
+            if not uid:
+                self.set_status(401)
+                return
+            body = json.loads(self.request.body)
+            seq = body.get("seq") if isinstance(body, dict) else None
+            # bool is an int in Python, true is not a seq.
+            if not isinstance(seq, int) or isinstance(seq, bool) or seq < 0:
+                raise ValueError("Wrong seq.")
+            if not await self.settings["membership_index"].is_member(ObjectId(roomId), uid):
+                raise ValueError("User is not a member of the room")
+            seq = await self.settings["room_summary"].mark_read(uid, roomId, seq)
+            self.set_status(200)
+            self.write(json.dumps({"seq": seq}))
+            return
+        except asyncio.CancelledError:
+            raise
+        except (bson.errors.InvalidId, ValueError):
+            tornado.log.app_log.warning("API using error: ", exc_info=True)
+
+        self.set_status(403)
+
+
 class LoginHandler(BaseHandler, ABC):
     """
     Handle login and logout with session.
@@ -441,9 +897,12 @@ class LoginHandler(BaseHandler, ABC):
                 raise ValueError("User or room not exists")
             uid = str(user_item["_id"])
             true_password = user_item["password"]
-            if Encryption.validation(password, true_password):
+            if await self.settings["password_pool"].validation(password, true_password):
                 token = token_generate(uid, 86400 * 5)
                 await my_redis.set(uid, token)
+                # Tokens issued before are replaced, drop them from the token cache of every process.
+                self.settings["token_cache"].invalidate(uid)
+                await self.settings["fanout"].publish_control("token", uid=uid)
                 self.write(json.dumps(
                     {
                         "userId": uid,
@@ -454,46 +913,291 @@ class LoginHandler(BaseHandler, ABC):
                 return
         except asyncio.CancelledError:
             raise
+        except PoolSaturated:
+            tornado.log.app_log.warning("Password pool saturated, login refused.")
+            self.set_status(503)
+            return
         except ValueError:
             tornado.log.app_log.warning("API using error: ", exc_info=True)
 
         self.set_status(403)
 
 
-def main():
-    client = motor.motor_tornado.MotorClient()
+def make_app(workers=1, metrics_enabled=True, production=False):
+    """
+        Build the app and its clients from the options of config.py.
+    """
+    options = tornado.options.options
+    metrics = AppMetrics() if metrics_enabled else None
+    mongo_listener = MongoPoolListener(metrics) if metrics is not None else None
+    client = motor.motor_tornado.MotorClient(
+        options.mongo_uri, event_listeners=[mongo_listener] if mongo_listener else [],
+        **config.mongo_client_kwargs())
     db = client.chatroom
+    history_db = client.get_database("chatroom", read_preference=config.read_preference(
+        options.mongo_history_read_preference))
+    profile_db = client.get_database("chatroom", read_preference=config.read_preference(
+        options.mongo_profile_read_preference))
+    if options.partition_storage:
+        partition_names = ["chatroom_p{}".format(n) for n in range(options.partitions)]
+        partition_dbs = [client.get_database(name) for name in partition_names]
+        partition_history_dbs = [client.get_database(name, read_preference=config.read_preference(
+            options.mongo_history_read_preference)) for name in partition_names]
+    else:
+        partition_dbs = partition_history_dbs = None
     lock = asyncio.Lock()
     settings = {
         "static_path": os.path.join(os.path.dirname(__file__), "static"),
         "xsrf_cookies": False,
     }
-    my_redis = aredis.StrictRedis(host="127.0.0.1", port=6379, db=0)
+    my_redis = aredis.StrictRedis(**config.redis_client_kwargs())
+    redis_client = my_redis
+    if metrics is not None:
+        db = InstrumentedDatabase(db, metrics)
+        history_db = InstrumentedDatabase(history_db, metrics)
+        profile_db = InstrumentedDatabase(profile_db, metrics)
+        my_redis = InstrumentedRedis(my_redis, metrics)
+        if partition_dbs is not None:
+            partition_dbs = [InstrumentedDatabase(d, metrics) for d in partition_dbs]
+            partition_history_dbs = [InstrumentedDatabase(d, metrics) for d in partition_history_dbs]
+    partitions = Partitions(options.partitions, {
+        "db": partition_dbs or [db] * options.partitions,
+        "history_db": partition_history_dbs or [history_db] * options.partitions,
+    })
+    room_hub = RoomHub()
+    fanout = RedisFanout(my_redis, room_hub)
+    token_cache = TokenCache(max_size=100000)
+    fanout.add_control_handler("token", lambda event: token_cache.invalidate(event["uid"]))
+    recent_cache = RecentMessageCache(room_capacity=500, max_bytes=64 * 1024 * 1024)
+    recent_cache.on_room_added = fanout.watch
+    recent_cache.on_room_removed = fanout.unwatch
+    recent_cache.is_live = fanout.is_subscribed
+    fanout.add_listener(recent_cache.on_message)
+    metadata_cache = MetadataCache(db, my_redis, ttl=options.metadata_cache_ttl,
+                                   redis_ttl=options.metadata_cache_redis_ttl)
+    metadata_cache.on_invalidate = lambda kind, object_ids: fanout.publish_control("meta", kind=kind, ids=object_ids)
+    fanout.add_control_handler("meta", lambda event: metadata_cache.evict_many(event["kind"], event["ids"]))
+    membership_index = MembershipIndex(db, max_rooms=100000)
+    room_summary = RoomSummary(my_redis, db, partitions)
+    partition_router = None
+    if options.partition_routing:
+        address = "{}:{}".format(options.advertise_host, options.internal_port + (tornado.process.task_id() or 0))
+        partition_router = PartitionRouter(my_redis, partitions, address,
+                                           max_clients=options.forward_max_clients,
+                                           connect_timeout=options.forward_connect_timeout,
+                                           request_timeout=options.forward_request_timeout)
+
+        def drop_given_rooms(given):
+            # Another worker serves these rooms now, their cached messages would only go stale.
+            given = set(given)
+            for room_id in recent_cache.rooms():
+                if partitions.of(room_id) in given:
+                    recent_cache.discard(room_id)
+
+        partition_router.on_rebalance = drop_given_rooms
+    rate_limits = {
+        "send": make_rate_limiter(options.rate_limit_mode, my_redis, "send", options.send_rate, options.send_burst),
+        "read": make_rate_limiter(options.rate_limit_mode, my_redis, "read", options.read_rate, options.read_burst),
+    }
+    concurrency_limits = {
+        "send": ConcurrencyLimiter(options.max_in_flight_send),
+        "read": ConcurrencyLimiter(options.max_in_flight_read),
+    }
+    blob_store = BlobStore(os.path.join(os.path.dirname(__file__), "blobs"))
+    fanout.add_control_handler("join", lambda event: membership_index.add_many(event["room_id"], event["uids"]))
     app = tornado.web.Application(
         [
             (r"/", BaseHandler),
             (r"/api/user/([0-9a-zA-z]+)", UserHandler),
             (r"/api/user/phoneNumber/([0-9]+)", UserPhoneNumberHandler),
             (r"/api/user", UserHandler),
+            (r"/api/users", UsersHandler),
             (r"/api/room/([0-9a-zA-z]+)/user/([0-9a-zA-z]+)", RoomChangeHandler),
+            (r"/api/room/([0-9a-zA-z]+)/users", RoomMembersHandler),
             (r"/api/room/([0-9a-zA-z]+)", RoomHandler),
             (r"/api/room", RoomHandler),
             (r"/api/message", MessageHandler),
             (r"/api/room/([0-9a-zA-z]+)/latest/([0-9]+)/([0-9]+)", RoomMessageHandler),
+            (r"/api/room/([0-9a-zA-z]+)/messages", MessagePageHandler),
+            (r"/api/room/([0-9a-zA-z]+)/read", RoomReadHandler),
+            (r"/api/summary", RoomSummaryHandler),
             (r"/api/session", LoginHandler),
+            (r"/api/push", MessagePushHandler),
+            (r"/api/blob", BlobUploadHandler),
+            (r"/api/blob/([0-9a-f]{64})", BlobHandler, {"path": blob_store.root}),
+            (r"/metrics", MetricsHandler),
         ],
+        # The push token may be in the query string, it must not reach the access log.
+        log_function=log_request,
+        # gzip for clients that accept it.
+        transforms=[ResponseCompression] if options.compress_responses else None,
         db=db,
+        history_db=history_db,
+        profile_db=profile_db,
+        read_your_writes_seconds=options.mongo_read_your_writes_seconds,
+        profile_reads_secondary=options.mongo_profile_read_preference != "primary",
+        history_reads_secondary=options.mongo_history_read_preference != "primary",
         client=client,
         message_num_per_document=100,
         max_message_num_per_get=500,
+        message_page_size=50,
+        seq_gap_timeout=10,
+        max_bulk_ids=5000,
+        response_batch_size=100,
+        archive_enabled=False,
+        archive_min_age_days=30,
+        archive_pause=0.05,
+        archive_interval=3600,
         my_lock=lock,
         my_redis=my_redis,
-        debug=True,
-        autoreload=True,
+        metrics=metrics,
+        room_hub=room_hub,
+        token_cache=token_cache,
+        password_pool_workers=4,
+        password_pool_max_pending=64,
+        password_pool_processes=False,
+        fanout=fanout,
+        recent_cache=recent_cache,
+        metadata_cache=metadata_cache,
+        membership_index=membership_index,
+        room_summary=room_summary,
+        partitions=partitions,
+        partition_router=partition_router,
+        requests=RequestCounter(),
+        draining=False,
+        rate_limits=rate_limits,
+        concurrency_limits=concurrency_limits,
+        push_queue_size=256,
+        push_compression={} if options.push_compression else None,
+        message_compress_threshold=options.message_compress_threshold,
+        blob_store=blob_store,
+        blob_max_size=32 * 1024 * 1024,
+        message_batch_max_size=64,
+        message_batch_linger_ms=5,
+        # Autoreload is not compatible with multiple processes.
+        debug=workers == 1 and not production,
+        autoreload=workers == 1 and not production,
         **settings
     )
-    app.listen(9999)
-    tornado.log.app_log.warning("Server running at port {}".format(9999))
+    app.settings["message_batcher"] = MessageBatcher(db, app.settings["message_num_per_document"],
+                                                     max_size=app.settings["message_batch_max_size"],
+                                                     linger_ms=app.settings["message_batch_linger_ms"],
+                                                     compress_threshold=app.settings["message_compress_threshold"],
+                                                     partitions=partitions)
+    app.settings["password_pool"] = PasswordPool(max_workers=app.settings["password_pool_workers"],
+                                                 max_pending=app.settings["password_pool_max_pending"],
+                                                 use_processes=app.settings["password_pool_processes"])
+    if metrics is not None:
+        register_gauges(metrics.registry, app.settings)
+        register_pool_gauges(metrics.registry, mongo_listener, redis_client,
+                             options.mongo_max_pool_size)
+    return app
+
+
+def log_request(handler):
+    """
+        Access log like the default one of tornado, with the token query argument of /api/push redacted.
+    """
+    status = handler.get_status()
+    if status < 400:
+        log_method = tornado.log.access_log.info
+    elif status < 500:
+        log_method = tornado.log.access_log.warning
+    else:
+        log_method = tornado.log.access_log.error
+    request = handler.request
+    uri = request.uri
+    if "token=" in request.query:
+        query = urllib.parse.parse_qsl(request.query, keep_blank_values=True)
+        uri = "{}?{}".format(request.path, urllib.parse.urlencode(
+            [(name, "redacted" if name == "token" else value) for name, value in query]))
+    log_method("%d %s %s (%s) %.2fms", status, request.method, uri, request.remote_ip,
+               1000.0 * request.request_time())
+
+
+def register_gauges(registry, settings):
+    batcher = settings["message_batcher"]
+    recent_cache = settings["recent_cache"]
+    token_cache = settings["token_cache"]
+    password_pool = settings["password_pool"]
+    registry.gauge("chatroom_batcher_batches_total", "Committed message batches.",
+                   lambda: batcher.batch_num, "counter")
+    registry.gauge("chatroom_batcher_messages_total", "Messages committed by the batcher.",
+                   lambda: batcher.message_num, "counter")
+    registry.gauge("chatroom_batcher_mean_batch_size", "Mean size of committed batches.",
+                   lambda: batcher.stats()["mean_batch_size"])
+    registry.gauge("chatroom_recent_cache_hits_total", "Reads served by the recent message cache.",
+                   lambda: recent_cache.hits, "counter")
+    registry.gauge("chatroom_recent_cache_misses_total", "Reads the recent message cache could not serve.",
+                   lambda: recent_cache.misses, "counter")
+    registry.gauge("chatroom_recent_cache_bytes", "Estimated size of the recent message cache.",
+                   lambda: recent_cache.bytes)
+    registry.gauge("chatroom_metadata_cache_hits_total", "User and room reads served from memory.",
+                   lambda: settings["metadata_cache"].hits, "counter")
+    registry.gauge("chatroom_metadata_cache_misses_total", "User and room reads not served from memory.",
+                   lambda: settings["metadata_cache"].misses, "counter")
+    registry.gauge("chatroom_token_cache_hits_total", "Tokens verified from the token cache.",
+                   lambda: token_cache.hits, "counter")
+    registry.gauge("chatroom_token_cache_misses_total", "Tokens verified against Redis.",
+                   lambda: token_cache.misses, "counter")
+    registry.gauge("chatroom_password_pool_pending", "Password jobs waiting or running.",
+                   lambda: password_pool.pending)
+    registry.gauge("chatroom_password_pool_rejected_total", "Password jobs refused by the pool.",
+                   lambda: password_pool.rejected, "counter")
+    for name, limiter in settings["rate_limits"].items():
+        if limiter is not None:
+            registry.gauge("chatroom_{}_rate_limited_total".format(name), "Requests refused with 429.",
+                           lambda limiter=limiter: limiter.rejected, "counter")
+    router = settings["partition_router"]
+    if router is not None:
+        registry.gauge("chatroom_partition_forwarded_total", "Requests forwarded to the owner of their room.",
+                       lambda: router.forwarded, "counter")
+        registry.gauge("chatroom_partition_forward_failed_total", "Forwards that failed, handled here or answered 503.",
+                       lambda: router.forward_failed, "counter")
+        registry.gauge("chatroom_partition_rebalances_total", "Changes of the live workers.",
+                       lambda: router.rebalances, "counter")
+        registry.gauge("chatroom_partition_owned", "Partitions owned by this worker.",
+                       lambda: router.owned())
+    for name, limiter in settings["concurrency_limits"].items():
+        registry.gauge("chatroom_{}_in_flight".format(name), "Requests in progress.",
+                       lambda limiter=limiter: limiter.in_flight)
+        registry.gauge("chatroom_{}_shed_total".format(name), "Requests shed with 503.",
+                       lambda limiter=limiter: limiter.rejected, "counter")
+
+
+def main():
+    options = config.load()
+    sockets = tornado.netutil.bind_sockets(options.port, reuse_port=options.reuse_port)
+    if options.workers != 1:
+        # Fork before any client or event loop is created, every worker builds its own.
+        tornado.process.fork_processes(options.workers)
+    app = make_app(options.workers, options.metrics, options.production)
+    tornado.ioloop.IOLoop.current().run_sync(lambda: ensure_indexes(app.settings["db"]))
+    message_dbs = [db for db in app.settings["partitions"].distinct_databases() if db is not app.settings["db"]]
+    for db in message_dbs:
+        tornado.ioloop.IOLoop.current().run_sync(lambda: ensure_indexes(db, PARTITIONED_COLLECTIONS))
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    internal_server = None
+    if app.settings["partition_router"] is not None:
+        # Requests forwarded by the other workers, see partition.py.
+        internal_server = tornado.httpserver.HTTPServer(app)
+        internal_server.add_sockets(tornado.netutil.bind_sockets(
+            options.internal_port + (tornado.process.task_id() or 0), reuse_port=options.reuse_port))
+        app.settings["partition_router"].start()
+    tornado.ioloop.IOLoop.current().spawn_callback(app.settings["fanout"].start)
+    if app.settings["metrics"] is not None:
+        tornado.ioloop.IOLoop.current().spawn_callback(app.settings["metrics"].start_lag_sampler)
+    if app.settings["archive_enabled"] and not tornado.process.task_id():
+        # One worker is enough to archive.
+        for db in app.settings["partitions"].distinct_databases():
+            job = ArchiveJob(db, app.settings["message_num_per_document"],
+                             min_age=datetime.timedelta(days=app.settings["archive_min_age_days"]),
+                             pause=app.settings["archive_pause"])
+            tornado.ioloop.IOLoop.current().spawn_callback(job.run_forever, app.settings["archive_interval"])
+    GracefulShutdown(server, app, options.shutdown_deadline, internal_server).install(
+        watch_parent=options.workers != 1)
+    tornado.log.app_log.warning("Server running at port {}, worker {}".format(options.port, tornado.process.task_id()))
     tornado.ioloop.IOLoop.current().start()
 
 
@@ -0,0 +1,421 @@
+import asyncio
+import contextvars
+import inspect
+import threading
+import time
+
+import pymongo.monitoring
+import tornado.web
+
+"""
+Author: Enigma Zhang
+
+Description:
+    This module collects metrics of the app and exposes them in the Prometheus text format on /metrics.
+
+    BaseHandler times every request. The Motor database and the aredis client in the settings are wrapped to count
+    the calls to Mongo and Redis and their time, in total and per request. Work shared by several requests, like the
+    batch commits of batcher.py, runs outside of any request and is only counted in total. When metrics are disabled
+    nothing is wrapped and BaseHandler only checks one setting.
+
+    The connection pools are observed too: MongoPoolListener times how long Mongo calls wait for a connection and
+    counts the connections in use, register_pool_gauges exposes them with the use of the Redis pool, so that
+    requests queueing for connections under burst load are visible.
+"""
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 32)
+
+# Calls to Mongo and Redis of the current request, see RequestStats.
+_request_stats = contextvars.ContextVar("request_stats", default=None)
+
+
+def _format_labels(names, values, extra=""):
+    labels = ",".join('{}="{}"'.format(name, value) for name, value in zip(names, values))
+    if extra:
+        labels = labels + "," + extra if labels else extra
+    return "{" + labels + "}" if labels else ""
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self._values = {}
+
+    def inc(self, labels=(), value=1):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} counter".format(self.name)]
+        for labels, value in self._values.items():
+            lines.append("{}{} {}".format(self.name, _format_labels(self.label_names, labels), value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        # labels -> [bucket counts..., sum, count]
+        self._values = {}
+
+    def observe(self, value, labels=()):
+        values = self._values.get(labels)
+        if values is None:
+            values = self._values[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                values[i] += 1
+        values[-2] += value
+        values[-1] += 1
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        for labels, values in self._values.items():
+            for bound, value in zip(self.buckets, values):
+                lines.append("{}_bucket{} {}".format(
+                    self.name, _format_labels(self.label_names, labels, 'le="{}"'.format(bound)), value))
+            lines.append("{}_bucket{} {}".format(
+                self.name, _format_labels(self.label_names, labels, 'le="+Inf"'), values[-1]))
+            lines.append("{}_sum{} {}".format(self.name, _format_labels(self.label_names, labels), values[-2]))
+            lines.append("{}_count{} {}".format(self.name, _format_labels(self.label_names, labels), values[-1]))
+        return lines
+
+
+class Gauge:
+    """
+        Value read from a callback when metrics are rendered, kind is gauge or counter.
+    """
+
+    def __init__(self, name, help_text, fn, kind="gauge"):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.kind = kind
+
+    def render(self):
+        return ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind),
+                "{} {}".format(self.name, self.fn())]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, label_names=()):
+        return self.add(Counter(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help_text, label_names, buckets))
+
+    def gauge(self, name, help_text, fn, kind="gauge"):
+        return self.add(Gauge(name, help_text, fn, kind))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class RequestStats:
+    __slots__ = ("mongo_calls", "mongo_time", "redis_calls", "redis_time")
+
+    def __init__(self):
+        self.mongo_calls = 0
+        self.mongo_time = 0.0
+        self.redis_calls = 0
+        self.redis_time = 0.0
+
+
+class AppMetrics:
+    """
+        The metrics of the app, stored in the settings as "metrics".
+    """
+
+    def __init__(self):
+        self.registry = Registry()
+        self.request_latency = self.registry.histogram(
+            "chatroom_request_duration_seconds", "Latency of requests.", ("route", "method", "status"))
+        self.request_mongo_calls = self.registry.histogram(
+            "chatroom_request_mongo_calls", "Mongo calls per request.", ("route",), COUNT_BUCKETS)
+        self.request_redis_calls = self.registry.histogram(
+            "chatroom_request_redis_calls", "Redis calls per request.", ("route",), COUNT_BUCKETS)
+        self.request_mongo_time = self.registry.histogram(
+            "chatroom_request_mongo_seconds", "Time spent in Mongo calls per request.", ("route",))
+        self.request_redis_time = self.registry.histogram(
+            "chatroom_request_redis_seconds", "Time spent in Redis calls per request.", ("route",))
+        self.mongo_calls = self.registry.histogram(
+            "chatroom_mongo_call_duration_seconds", "Latency of Mongo calls.", ("collection", "operation"))
+        self.redis_calls = self.registry.histogram(
+            "chatroom_redis_call_duration_seconds", "Latency of Redis calls.", ("command",))
+        self.event_loop_lag = self.registry.histogram(
+            "chatroom_event_loop_lag_seconds", "Delay of event loop callbacks after their due time.")
+        self._lag_sampler = None
+
+    def start_request(self):
+        stats = RequestStats()
+        _request_stats.set(stats)
+        return stats
+
+    def finish_request(self, handler, start, stats):
+        route = type(handler).__name__
+        self.request_latency.observe(time.perf_counter() - start,
+                                     (route, handler.request.method, handler.get_status()))
+        self.request_mongo_calls.observe(stats.mongo_calls, (route,))
+        self.request_redis_calls.observe(stats.redis_calls, (route,))
+        self.request_mongo_time.observe(stats.mongo_time, (route,))
+        self.request_redis_time.observe(stats.redis_time, (route,))
+
+    def observe_mongo(self, collection, operation, elapsed):
+        self.mongo_calls.observe(elapsed, (collection, operation))
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.mongo_calls += 1
+            stats.mongo_time += elapsed
+
+    def observe_redis(self, command, elapsed):
+        self.redis_calls.observe(elapsed, (command,))
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.redis_calls += 1
+            stats.redis_time += elapsed
+
+    def start_lag_sampler(self, interval=0.5):
+        self._lag_sampler = asyncio.ensure_future(self._sample_lag(interval))
+
+    async def _sample_lag(self, interval):
+        loop = asyncio.get_event_loop()
+        while True:
+            due = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.event_loop_lag.observe(max(0.0, loop.time() - due))
+
+
+class MongoPoolListener(pymongo.monitoring.ConnectionPoolListener):
+    """
+        Connection pool events of the Mongo client. Motor checks out connections in its executor threads, the time
+        a checkout waited is measured per thread.
+    """
+
+    def __init__(self, metrics):
+        self.wait = metrics.registry.histogram(
+            "chatroom_mongo_pool_wait_seconds", "Time Mongo calls waited for a pooled connection.")
+        self.checked_out = 0
+        self.created = 0
+        self.failed = 0
+        self._local = threading.local()
+
+    def connection_check_out_started(self, event):
+        self._local.start = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        self.checked_out += 1
+        self._observe_wait()
+
+    def connection_check_out_failed(self, event):
+        self.failed += 1
+        self._observe_wait()
+
+    def connection_checked_in(self, event):
+        self.checked_out -= 1
+
+    def connection_created(self, event):
+        self.created += 1
+
+    def connection_closed(self, event):
+        self.created -= 1
+
+    def _observe_wait(self):
+        start = getattr(self._local, "start", None)
+        if start is not None:
+            self.wait.observe(time.perf_counter() - start)
+            self._local.start = None
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+
+def register_pool_gauges(registry, mongo_listener, my_redis, mongo_max_pool_size):
+    pool = my_redis.connection_pool
+    registry.gauge("chatroom_mongo_pool_connections", "Open Mongo connections.", lambda: mongo_listener.created)
+    registry.gauge("chatroom_mongo_pool_checked_out", "Mongo connections in use.",
+                   lambda: mongo_listener.checked_out)
+    registry.gauge("chatroom_mongo_pool_max_size", "Maximum Mongo connections per server.",
+                   lambda: mongo_max_pool_size)
+    registry.gauge("chatroom_mongo_pool_checkout_failed_total", "Mongo calls that got no connection.",
+                   lambda: mongo_listener.failed, "counter")
+    # aredis does not expose the state of its pool.
+    registry.gauge("chatroom_redis_pool_in_use", "Redis connections in use.",
+                   lambda: len(getattr(pool, "_in_use_connections", ())))
+    registry.gauge("chatroom_redis_pool_connections", "Open Redis connections.",
+                   lambda: getattr(pool, "_created_connections", 0))
+    registry.gauge("chatroom_redis_pool_max_size", "Maximum Redis connections.", lambda: pool.max_connections)
+
+
+class InstrumentedDatabase:
+    """
+        Wraps a Motor database, its collections count and time their calls.
+    """
+
+    def __init__(self, db, metrics):
+        self._db = db
+        self._metrics = metrics
+        self._collections = {}
+
+    def __getitem__(self, name):
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = InstrumentedCollection(self._db[name], self._metrics)
+        return collection
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    @property
+    def delegate(self):
+        return self._db
+
+
+class InstrumentedCollection:
+    _operations = frozenset((
+        "find_one", "insert_one", "insert_many", "update_one", "update_many", "delete_one", "delete_many",
+        "count_documents", "find_one_and_update", "find_one_and_delete", "bulk_write", "create_index", "distinct",
+    ))
+
+    def __init__(self, collection, metrics):
+        self._collection = collection
+        self._metrics = metrics
+        self._name = collection.name
+
+    def find(self, *args, **kwargs):
+        return InstrumentedCursor(self._collection.find(*args, **kwargs), self._name, self._metrics)
+
+    def with_options(self, **kwargs):
+        return InstrumentedCollection(self._collection.with_options(**kwargs), self._metrics)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name not in self._operations:
+            return attribute
+        metrics = self._metrics
+        collection = self._name
+
+        async def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await attribute(*args, **kwargs)
+            finally:
+                metrics.observe_mongo(collection, name, time.perf_counter() - start)
+
+        return call
+
+
+class InstrumentedCursor:
+    """
+        Wraps a Motor cursor, the time spent fetching its documents is counted as one call.
+    """
+
+    def __init__(self, cursor, collection, metrics):
+        self._cursor = cursor
+        self._collection = collection
+        self._metrics = metrics
+        self._elapsed = 0.0
+        self._iterator = None
+
+    def sort(self, *args, **kwargs):
+        self._cursor.sort(*args, **kwargs)
+        return self
+
+    def limit(self, *args, **kwargs):
+        self._cursor.limit(*args, **kwargs)
+        return self
+
+    def batch_size(self, *args, **kwargs):
+        self._cursor.batch_size(*args, **kwargs)
+        return self
+
+    async def to_list(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await self._cursor.to_list(*args, **kwargs)
+        finally:
+            self._metrics.observe_mongo(self._collection, "find", time.perf_counter() - start)
+
+    async def explain(self):
+        return await self._cursor.explain()
+
+    def __aiter__(self):
+        self._iterator = self._cursor.__aiter__()
+        return self
+
+    async def __anext__(self):
+        start = time.perf_counter()
+        try:
+            return await self._iterator.__anext__()
+        except StopAsyncIteration:
+            self._metrics.observe_mongo(self._collection, "find", self._elapsed + time.perf_counter() - start)
+            raise
+        finally:
+            self._elapsed += time.perf_counter() - start
+
+
+class InstrumentedRedis:
+    """
+        Wraps an aredis client, its commands count and time their calls.
+    """
+
+    def __init__(self, my_redis, metrics):
+        self._redis = my_redis
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attribute = getattr(self._redis, name)
+        if not inspect.iscoroutinefunction(attribute):
+            return attribute
+        metrics = self._metrics
+
+        async def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await attribute(*args, **kwargs)
+            finally:
+                metrics.observe_redis(name, time.perf_counter() - start)
+
+        return call
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Handle /metrics
+    """
+
+    def get(self, *args, **kwargs):
+        metrics = self.settings["metrics"]
+        if metrics is None:
+            self.set_status(404)
+            return
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.registry.render())
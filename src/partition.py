@@ -0,0 +1,224 @@
+import asyncio
+import bisect
+import hashlib
+import socket
+import time
+import zlib
+
+import tornado.httpclient
+import tornado.log
+from bson.objectid import ObjectId
+
+"""
+Author: Enigma Zhang
+
+Description:
+    This module partitions rooms so that the state of a room stays with one worker and its messages can be stored
+    apart from the other rooms.
+
+    A room belongs to one of num_partitions logical partitions, from a hash of its id. The number of partitions never
+    changes, so the partition of a room never changes either. With partitioned storage the message and room_message
+    collections of partition n are in the database chatroom_p{n}, the room and user documents stay in chatroom.
+
+    Partitions are assigned to the live workers with a consistent hash ring. Workers announce themselves in Redis
+    with heartbeats, when one joins or leaves only the partitions it takes or gives move. A request for a room that
+    lands on another worker is forwarded to the owner of the room. Ownership only keeps the caches and batches of a
+    room on one worker, every path stays correct when two workers see different owners during a rebalance or when
+    the owner cannot be reached and the request is handled where it landed.
+"""
+
+# Collections stored in the database of the partition of their room with partitioned storage.
+PARTITIONED_COLLECTIONS = ("message", "room_message")
+WORKERS_KEY = "chatroom:partition:workers"
+FORWARDED_HEADER = "X-Chatroom-Forwarded"
+# Headers of the original request that are not forwarded.
+_HOP_HEADERS = frozenset(("Host", "Content-Length", "Connection", "Transfer-Encoding", "Accept-Encoding", "Keep-Alive"))
+# Headers of the owner's response that are copied to the client.
+_RESPONSE_HEADERS = ("Content-Type", "Retry-After", "X-Last-Write")
+
+
+def partition_of(room_id, num_partitions):
+    return zlib.crc32(ObjectId(room_id).binary) % num_partitions
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+        Consistent hash ring of nodes, each with vnodes points so that the keys spread evenly.
+    """
+
+    def __init__(self, nodes=(), vnodes=64):
+        self.nodes = sorted(set(nodes))
+        points = sorted((_hash("{}#{}".format(node, i)), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [point[0] for point in points]
+        self._nodes = [point[1] for point in points]
+
+    def node_of(self, key):
+        if not self._nodes:
+            return None
+        return self._nodes[bisect.bisect(self._hashes, _hash(str(key))) % len(self._nodes)]
+
+
+class Partitions:
+    """
+        Partition of each room and the databases of its message collections, stored in the settings as "partitions".
+    """
+
+    def __init__(self, num_partitions, databases):
+        """
+            databases maps a database setting name, "db" or "history_db", to the database of each partition.
+        """
+        self.num_partitions = num_partitions
+        self._databases = databases
+
+    def of(self, room_id):
+        return partition_of(room_id, self.num_partitions)
+
+    def database(self, room_id, kind="db"):
+        return self._databases[kind][self.of(room_id)]
+
+    def distinct_databases(self, kind="db"):
+        """
+            Every database holding message collections, once.
+        """
+        return list({id(db): db for db in self._databases[kind]}.values())
+
+
+class PartitionRouter:
+    """
+        Owner of each partition among the live workers, and forwarding of requests to it.
+    """
+
+    def __init__(self, my_redis, partitions, address, vnodes=64, heartbeat_interval=1, worker_ttl=5,
+                 max_clients=1000, connect_timeout=1.0, request_timeout=10.0):
+        self._redis = my_redis
+        self._partitions = partitions
+        self.address = address
+        self._vnodes = vnodes
+        self._heartbeat_interval = heartbeat_interval
+        self._worker_ttl = worker_ttl
+        self._ring = HashRing([address], vnodes)
+        self._owners = [address] * partitions.num_partitions
+        self._task = None
+        # Its own client, the shared default one allows 10 requests at once and most requests are forwarded.
+        self.http = tornado.httpclient.AsyncHTTPClient(force_instance=True, max_clients=max_clients)
+        self._connect_timeout = connect_timeout
+        self._request_timeout = request_timeout
+        self.forwarded = 0
+        self.forward_failed = 0
+        self.rebalances = 0
+        # Called with the list of partitions this worker gave away after a rebalance.
+        self.on_rebalance = None
+
+    def owner(self, room_id):
+        return self._owners[self._partitions.of(room_id)]
+
+    def owns(self, room_id):
+        return self.owner(room_id) == self.address
+
+    def owned(self):
+        return sum(1 for owner in self._owners if owner == self.address)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._heartbeat())
+
+    async def leave(self):
+        """
+            Stop owning partitions, the other workers take them at their next heartbeat.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self._redis.zrem(WORKERS_KEY, self.address)
+
+    async def _heartbeat(self):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                tornado.log.app_log.warning("Partition heartbeat failed: ", exc_info=True)
+            await asyncio.sleep(self._heartbeat_interval)
+
+    async def refresh(self):
+        now = time.time()
+        await self._redis.zadd(WORKERS_KEY, now, self.address)
+        await self._redis.zremrangebyscore(WORKERS_KEY, "-inf", now - self._worker_ttl * 10)
+        workers = [worker.decode() for worker in
+                   await self._redis.zrangebyscore(WORKERS_KEY, now - self._worker_ttl, "+inf")]
+        if self.address not in workers:
+            workers.append(self.address)
+        if sorted(workers) != self._ring.nodes:
+            self.rebalance(workers)
+
+    def rebalance(self, workers):
+        ring = HashRing(workers, self._vnodes)
+        owners = [ring.node_of(partition) for partition in range(self._partitions.num_partitions)]
+        moved = sum(1 for old, new in zip(self._owners, owners) if old != new)
+        given = [p for p, (old, new) in enumerate(zip(self._owners, owners)) if old == self.address != new]
+        self._ring = ring
+        self._owners = owners
+        self.rebalances += 1
+        tornado.log.app_log.warning("Partitions rebalanced over {} workers, {} of {} moved".format(
+            len(ring.nodes), moved, len(owners)))
+        if given and self.on_rebalance is not None:
+            self.on_rebalance(given)
+
+    async def forward(self, handler, room_id):
+        """
+            Send the request of handler to the owner of room_id and write its response. Returns False if the request
+            must be handled here: this worker owns the room, the request was already forwarded, or the owner could
+            not be reached. A request that may have reached the owner is answered 503, handling it here too could
+            commit a message twice.
+        """
+        request = handler.request
+        if room_id is None or FORWARDED_HEADER in request.headers:
+            return False
+        try:
+            owner = self.owner(room_id)
+        except Exception:
+            # Not a room id, the handler answers the error.
+            return False
+        if owner == self.address:
+            return False
+        headers = {name: value for name, value in request.headers.get_all() if name not in _HOP_HEADERS}
+        headers[FORWARDED_HEADER] = self.address
+        try:
+            response = await self.http.fetch("http://{}{}".format(owner, request.uri), method=request.method,
+                                             headers=headers, body=request.body if request.body else None,
+                                             allow_nonstandard_methods=True, follow_redirects=False,
+                                             connect_timeout=self._connect_timeout,
+                                             request_timeout=self._request_timeout, raise_error=False)
+        except asyncio.CancelledError:
+            raise
+        except (ConnectionRefusedError, socket.gaierror):
+            # Never connected, the owner has not seen the request.
+            self.forward_failed += 1
+            tornado.log.app_log.warning("Owner {} unreachable, handled here.".format(owner))
+            return False
+        except Exception:
+            tornado.log.app_log.warning("Forwarding to {} failed: ".format(owner), exc_info=True)
+            self._unavailable(handler)
+            return True
+        if response.code == 599:
+            self._unavailable(handler)
+            return True
+        self.forwarded += 1
+        handler.set_status(response.code, response.reason)
+        for name in _RESPONSE_HEADERS:
+            if name in response.headers:
+                handler.set_header(name, response.headers[name])
+        for cookie in response.headers.get_list("Set-Cookie"):
+            handler.add_header("Set-Cookie", cookie)
+        if response.body:
+            handler.write(response.body)
+        return True
+
+    def _unavailable(self, handler):
+        self.forward_failed += 1
+        handler.set_status(503)
+        handler.set_header("Retry-After", "1")
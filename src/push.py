@@ -0,0 +1,165 @@
+import asyncio
+
+import bson
+import tornado.log
+import tornado.websocket
+from bson.objectid import ObjectId
+
+from tools import auth_with_token, token_validation
+
+"""
+Author: Enigma Zhang
+
+Description:
+    This module pushes committed messages to connected clients over WebSocket, so clients do not need to poll
+    RoomMessageHandler for new messages.
+"""
+
+
+class RoomHub:
+    """
+        Registry of the live push connections of this process, indexed by room id and by user id.
+    """
+
+    def __init__(self):
+        self._rooms = {}
+        self._users = {}
+        # Called with a room id when the first local connection subscribes to it and when the last one leaves.
+        self.on_room_added = None
+        self.on_room_removed = None
+
+    def subscribe(self, connection, uid, room_ids):
+        self._users.setdefault(uid, set()).add(connection)
+        for room_id in room_ids:
+            connections = self._rooms.get(room_id)
+            if connections is None:
+                connections = self._rooms[room_id] = set()
+                if self.on_room_added is not None:
+                    self.on_room_added(room_id)
+            connections.add(connection)
+
+    def unsubscribe(self, connection, uid, room_ids):
+        for room_id in room_ids:
+            connections = self._rooms.get(room_id)
+            if connections is not None:
+                connections.discard(connection)
+                if not connections:
+                    del self._rooms[room_id]
+                    if self.on_room_removed is not None:
+                        self.on_room_removed(room_id)
+        connections = self._users.get(uid)
+        if connections is not None:
+            connections.discard(connection)
+            if not connections:
+                del self._users[uid]
+
+    def add_member(self, room_id, uid):
+        """
+            Subscribe the open connections of user uid to a room it has just joined.
+        """
+        for connection in list(self._users.get(uid, ())):
+            connection.join_room(room_id)
+
+    def rooms(self):
+        return list(self._rooms.keys())
+
+    def close_all(self, code=None, reason=None):
+        """
+            Close every connection, on shutdown.
+        """
+        for connections in list(self._users.values()):
+            for connection in list(connections):
+                connection.close(code, reason)
+
+    def deliver(self, room_id, payload):
+        """
+            Push an already encoded message to every connection subscribed to the room.
+        """
+        for connection in list(self._rooms.get(room_id, ())):
+            connection.enqueue(payload)
+
+
+class MessagePushHandler(tornado.websocket.WebSocketHandler):
+    """
+    Handle /api/push with the token in the Authorization header, or /api/push?token={token}
+
+    Authenticates once when the socket is opened, then pushes every message committed to the rooms of the user.
+    Each socket has a bounded outgoing queue, a consumer that falls behind is disconnected and should catch up
+    through RoomMessageHandler.
+    """
+
+    def initialize(self):
+        self.uid = None
+        self.room_ids = set()
+        self._queue = None
+        self._sender = None
+
+    async def get(self, *args, **kwargs):
+        # The header is preferred, browsers cannot set it on a WebSocket and pass ?token=, redacted in the access log.
+        token = self.request.headers.get("Authorization", "") or self.get_query_argument("token", None) or ""
+        if token.startswith("Bearer"):
+            token = token[len("Bearer"):].strip()
+        if not token or not await auth_with_token(self.settings["my_redis"], token,
+                                                                self.settings["token_cache"]):
+            self.set_status(401)
+            self.finish()
+            return
+        self.uid = token_validation(token)
+        try:
+            user_id = ObjectId(self.uid)
+        except bson.errors.InvalidId:
+            user_id = None
+        db = self.settings["db"]
+        if user_id is None or await db.user.find_one({"_id": user_id}, projection={"_id": 1}) is None:
+            self.set_status(403)
+            self.finish()
+            return
+        # The rooms the user is a member of, user.rooms is not trusted. Members may be stored as strings.
+        self.room_ids = {str(room["_id"]) async for room in
+                         db.room.find({"members": {"$in": [user_id, self.uid]}}, projection={"_id": 1})}
+        await super().get(*args, **kwargs)
+
+    def get_compression_options(self):
+        # permessage-deflate when the client offers it, None turns it off.
+        return self.settings["push_compression"]
+
+    def open(self, *args, **kwargs):
+        self._queue = asyncio.Queue(maxsize=self.settings["push_queue_size"])
+        self._sender = asyncio.ensure_future(self._send_loop())
+        self.settings["room_hub"].subscribe(self, self.uid, self.room_ids)
+
+    def join_room(self, room_id):
+        if room_id not in self.room_ids:
+            self.room_ids.add(room_id)
+            self.settings["room_hub"].subscribe(self, self.uid, [room_id])
+
+    def enqueue(self, payload):
+        if self._queue is None:
+            return
+        try:
+            self._queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            tornado.log.app_log.warning("Push queue of user {} is full, closing.".format(self.uid))
+            self._queue = None
+            self.close(1013, "Too many pending messages")
+
+    async def _send_loop(self):
+        queue = self._queue
+        try:
+            while True:
+                payload = await queue.get()
+                await self.write_message(payload)
+        except tornado.websocket.WebSocketClosedError:
+            pass
+        except asyncio.CancelledError:
+            raise
+
+    def on_message(self, message):
+        # The channel is push only, messages are sent through MessageHandler.
+        pass
+
+    def on_close(self):
+        self.settings["room_hub"].unsubscribe(self, self.uid, self.room_ids)
+        self._queue = None
+        if self._sender is not None:
+            self._sender.cancel()
@@ -0,0 +1,144 @@
+import collections
+import time
+
+import tornado.log
+
+"""
+Author: Enigma Zhang
+
+Description:
+    This module limits the load a single user or a burst of requests can put on the app.
+
+    TokenBucketLimiter gives every user rate requests per second with bursts of up to burst requests, in process
+    memory. RedisTokenBucketLimiter keeps the buckets in Redis with a Lua script, so the limit holds across workers,
+    and falls back to the in-process buckets when Redis fails. ConcurrencyLimiter caps the requests of a route in
+    progress at once, requests over the cap are shed before they touch the database.
+"""
+
+
+class TokenBucketLimiter:
+    """
+        Token buckets keyed by uid, the least recently used are dropped beyond max_keys, a dropped bucket is full.
+    """
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._max_keys = max_keys
+        # key -> [tokens, time of tokens]
+        self._buckets = collections.OrderedDict()
+        self.rejected = 0
+
+    async def allow(self, key, cost=1):
+        """
+            Take cost tokens from the bucket of key, return 0 if allowed or the seconds to wait before retrying.
+        """
+        return self.take(key, cost)
+
+    def take(self, key, cost=1):
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self._burst, now]
+            if len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self._burst, bucket[0] + (now - bucket[1]) * self._rate)
+            bucket[1] = now
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return 0
+        self.rejected += 1
+        return (cost - bucket[0]) / self._rate if self._rate else 1.0
+
+
+# KEYS[1] bucket, ARGV rate, burst, cost. Redis time keeps the buckets consistent across hosts.
+_TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+local tokens = tonumber(bucket[1])
+if tokens == nil then
+    tokens = burst
+else
+    tokens = math.min(burst, tokens + (now - tonumber(bucket[2])) * rate)
+end
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+elseif rate > 0 then
+    wait = (cost - tokens) / rate
+else
+    wait = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'time', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / math.max(rate, 0.001)) + 1)
+return tostring(wait)
+"""
+
+
+class RedisTokenBucketLimiter:
+    """
+        Token buckets shared by every worker in Redis, with the same interface as TokenBucketLimiter.
+    """
+
+    def __init__(self, my_redis, name, rate, burst, max_keys=100000):
+        self._redis = my_redis
+        self._prefix = "chatroom:ratelimit:{}:".format(name)
+        self._rate = rate
+        self._burst = burst
+        self._fallback = TokenBucketLimiter(rate, burst, max_keys)
+        self._rejected = 0
+
+    @property
+    def rejected(self):
+        return self._rejected + self._fallback.rejected
+
+    async def allow(self, key, cost=1):
+        try:
+            wait = float(await self._redis.eval(_TOKEN_BUCKET_SCRIPT, 1, self._prefix + key,
+                                                self._rate, self._burst, cost))
+        except Exception:
+            tornado.log.app_log.warning("Redis rate limit failed, limiting in process: ", exc_info=True)
+            return self._fallback.take(key, cost)
+        if wait:
+            self._rejected += 1
+        return wait
+
+
+class ConcurrencyLimiter:
+    """
+        At most max_in_flight requests at once, 0 for no limit.
+    """
+
+    def __init__(self, max_in_flight):
+        self._max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.rejected = 0
+
+    def acquire(self):
+        if self._max_in_flight and self.in_flight >= self._max_in_flight:
+            self.rejected += 1
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+
+
+def make_rate_limiter(mode, my_redis, name, rate, burst):
+    """
+        Limiter of a mode: "local", "redis" or "off" for None.
+    """
+    if mode == "off" or rate <= 0:
+        return None
+    if mode == "redis":
+        return RedisTokenBucketLimiter(my_redis, name, rate, burst)
+    if mode == "local":
+        return TokenBucketLimiter(rate, burst)
+    raise ValueError("Unknown rate limit mode: {}".format(mode))
@@ -0,0 +1,111 @@
+import sys
+
+import motor.motor_tornado
+import pymongo
+import tornado.ioloop
+import tornado.log
+from bson.objectid import ObjectId
+
+"""
+Author: Enigma Zhang
+
+Description:
+    This module declares the indexes of every collection and creates them at startup.
+
+    Run it directly to check the query plans of the handlers against a local mongod, it fails if one of the
+    queries scans a whole collection:
+
+        python schema.py --explain
+"""
+
+# collection -> list of (keys, options)
+INDEXES = {
+    "user": [
+        # Registration uniqueness, LoginHandler and UserPhoneNumberHandler lookups.
+        ([("phoneNumber", pymongo.ASCENDING)], {"unique": True}),
+    ],
+    "room": [
+        ([("members", pymongo.ASCENDING)], {}),
+    ],
+    "room_message": [
+        # Concurrent senders upsert the same bucket, the unique index lets only one of them create it.
+        ([("room_id", pymongo.ASCENDING), ("index", pymongo.ASCENDING)], {"unique": True}),
+        # Archives whose source messages are not deleted yet, see ArchiveJob.finish_archives.
+        ([("cleaned", pymongo.ASCENDING)], {"partialFilterExpression": {"cleaned": False}}),
+    ],
+    "message": [
+        # Sequence paged reads of MessagePageHandler.
+        ([("roomId", pymongo.ASCENDING), ("seq", pymongo.ASCENDING)], {"unique": True}),
+        ([("roomId", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)], {}),
+    ],
+}
+
+
+async def ensure_indexes(db, collections=None):
+    """
+        Create the declared indexes of collections, all by default. Indexes that already exist are left as they are.
+    """
+    for collection, indexes in INDEXES.items():
+        if collections is not None and collection not in collections:
+            continue
+        for keys, options in indexes:
+            await db[collection].create_index(keys, **options)
+
+
+def _queries():
+    """
+        The queries of the handlers with sample arguments, as (name, collection, filter, sort).
+    """
+    oid = ObjectId()
+    return [
+        ("UserHandler.get", "user", {"_id": oid}, None),
+        ("UserHandler.post", "user", {"phoneNumber": "0"}, None),
+        ("UserPhoneNumberHandler.get", "user", {"phoneNumber": "0"}, None),
+        ("RoomHandler.get", "room", {"_id": oid}, None),
+        ("RoomChangeHandler.post", "room", {"_id": oid, "members": oid}, None),
+        ("MessageHandler.post bucket", "room_message", {"room_id": oid, "index": 0}, None),
+        ("RoomMessageHandler.get buckets", "room_message", {"_id": {"$in": [oid]}}, None),
+        ("RoomMessageHandler.get messages", "message", {"_id": {"$in": [oid]}}, [("seq", pymongo.DESCENDING)]),
+        ("MessagePageHandler.get", "message", {"roomId": str(oid), "seq": {"$gt": 0}},
+         [("seq", pymongo.ASCENDING)]),
+    ]
+
+
+def _stages(plan):
+    yield plan.get("stage")
+    if "inputStage" in plan:
+        yield from _stages(plan["inputStage"])
+    for stage in plan.get("inputStages", []):
+        yield from _stages(stage)
+
+
+async def check_query_plans(db):
+    """
+        Explain the queries of the handlers and return the names of those whose winning plan is a COLLSCAN.
+    """
+    failed = []
+    for name, collection, query, sort in _queries():
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = (await cursor.explain())["queryPlanner"]["winningPlan"]
+        if "COLLSCAN" in _stages(plan):
+            failed.append(name)
+    return failed
+
+
+async def _explain(db):
+    await ensure_indexes(db)
+    return await check_query_plans(db)
+
+
+if __name__ == "__main__":
+    if "--explain" not in sys.argv[1:]:
+        print("usage: python schema.py --explain [mongodb uri]")
+        sys.exit(2)
+    uri = next((arg for arg in sys.argv[1:] if not arg.startswith("--")), "mongodb://127.0.0.1:27017")
+    database = motor.motor_tornado.MotorClient(uri).chatroom
+    collscans = tornado.ioloop.IOLoop.current().run_sync(lambda: _explain(database))
+    for query_name in collscans:
+        tornado.log.app_log.error("COLLSCAN: {}".format(query_name))
+    sys.exit(1 if collscans else 0)
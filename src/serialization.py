@@ -0,0 +1,77 @@
+import json
+
+from bson.objectid import ObjectId
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+"""
+Author: Enigma Zhang
+
+Description:
+    This module encodes documents of the database to JSON.
+
+    ObjectId values are encoded as strings by the encoder itself, so documents do not need to be converted before
+    they are written. orjson is used when it is installed, the standard json module otherwise.
+"""
+
+
+def _default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, default=_default, ensure_ascii=False).encode("utf-8")
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, default=_default)
+
+
+ENCODERS = {"json": _json_dumps}
+if orjson is not None:
+    ENCODERS["orjson"] = _orjson_dumps
+
+_dumps = ENCODERS["orjson" if orjson is not None else "json"]
+
+
+def use_encoder(name):
+    """
+        Select the encoder by name, one of ENCODERS.
+    """
+    global _dumps
+    if name not in ENCODERS:
+        raise ValueError("Unknown or not installed JSON encoder: {}".format(name))
+    _dumps = ENCODERS[name]
+
+
+def dumps(obj):
+    """
+        Encode obj to UTF-8 JSON bytes.
+    """
+    return _dumps(obj)
+
+
+async def write_list(handler, cursor, batch_size=100, on_item=None):
+    """
+        Write the documents of an async cursor to handler as a JSON list, flushing every batch_size documents instead
+        of building the whole response in memory. on_item is called with every document written.
+        The status and headers must be set before, they are sent with the first batch.
+    """
+    handler.write(b"[")
+    num = 0
+    async for item in cursor:
+        if num:
+            handler.write(b",")
+        handler.write(_dumps(item))
+        if on_item is not None:
+            on_item(item)
+        num += 1
+        if num % batch_size == 0:
+            await handler.flush()
+    handler.write(b"]")
+    return num
@@ -0,0 +1,109 @@
+import asyncio
+import os
+import signal
+import time
+
+import tornado.ioloop
+import tornado.log
+
+"""
+Author: Enigma Zhang
+
+Description:
+    This module stops a worker without losing the requests it has accepted.
+
+    On SIGTERM or SIGINT, or when the parent process of a forked worker is gone, the worker stops listening, closes
+    the push connections with 1012 (service restart), answers the requests in progress with Connection: close so
+    keep-alive clients reconnect elsewhere, waits for them until a deadline, commits the pending message batches and
+    stops its event loop. With partition routing it first leaves the ring so that the other workers stop forwarding
+    to it.
+
+    With --reuse_port a new server can listen on the port of a running one, so a restart is: start the new server,
+    then send SIGTERM to the old one.
+"""
+
+
+class RequestCounter:
+    """
+        Requests of BaseHandler in progress.
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+
+    def acquire(self):
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+
+
+class GracefulShutdown:
+    def __init__(self, server, app, deadline=30, internal_server=None):
+        self._server = server
+        self._internal_server = internal_server
+        self._app = app
+        self._deadline = deadline
+        self._stopping = False
+        self._parent = os.getppid()
+
+    def install(self, watch_parent=False):
+        """
+            Handle SIGTERM and SIGINT, and the death of the parent process if watch_parent.
+        """
+        io_loop = tornado.ioloop.IOLoop.current()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                asyncio.get_event_loop().add_signal_handler(signum, self.start)
+            except NotImplementedError:
+                # Windows.
+                signal.signal(signum, lambda *args: io_loop.add_callback_from_signal(self.start))
+        if watch_parent:
+            tornado.ioloop.PeriodicCallback(self._check_parent, 1000).start()
+
+    def _check_parent(self):
+        if os.getppid() != self._parent:
+            tornado.log.app_log.warning("Parent process exited.")
+            self.start()
+
+    def start(self):
+        if not self._stopping:
+            self._stopping = True
+            asyncio.ensure_future(self.stop())
+
+    async def stop(self):
+        settings = self._app.settings
+        deadline = time.monotonic() + self._deadline
+        tornado.log.app_log.warning("Shutting down, {} requests in progress".format(
+            settings["requests"].in_flight))
+        if settings["partition_router"] is not None:
+            # The other workers take the partitions of this one and stop forwarding to it at their next heartbeat.
+            try:
+                await settings["partition_router"].leave()
+            except Exception:
+                tornado.log.app_log.warning("Leaving the partition ring failed: ", exc_info=True)
+        self._server.stop()
+        if self._internal_server is not None:
+            self._internal_server.stop()
+        settings["draining"] = True
+        settings["room_hub"].close_all(1012, "Server restart")
+        while settings["requests"].in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if settings["requests"].in_flight:
+            tornado.log.app_log.warning("{} requests still in progress at the deadline".format(
+                settings["requests"].in_flight))
+        try:
+            await settings["message_batcher"].flush_all()
+        except Exception:
+            tornado.log.app_log.warning("Flushing message batches failed: ", exc_info=True)
+        try:
+            await asyncio.wait_for(self._server.close_all_connections(), max(1.0, deadline - time.monotonic()))
+            if self._internal_server is not None:
+                await asyncio.wait_for(self._internal_server.close_all_connections(),
+                                       max(1.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            pass
+        await settings["fanout"].stop()
+        settings["password_pool"].shutdown()
+        tornado.log.app_log.warning("Shutdown complete.")
+        tornado.ioloop.IOLoop.current().stop()
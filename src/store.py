@@ -0,0 +1,103 @@
+import asyncio
+import time
+
+import pymongo
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from compression import pack_content
+
+"""
+Author: Enigma Zhang
+
+Description:
+    This module appends messages to rooms with atomic operations instead of a read-modify-write transaction.
+
+    The room document keeps the message counter. Incrementing it gives each message its sequence number seq, and
+    seq decides the room_message bucket of the message: bucket index (seq - 1) // message_num_per_document. Buckets
+    are addressed by (room_id, index), unique by an index declared in schema.py, and room.room_message_id[index] is
+    the id of bucket index, so concurrent senders never need to read a bucket to know where to write.
+
+    The message and room_message collections may be in the database of the partition of the room (see
+    partition.py), given as message_db. The room document is always in db.
+"""
+
+
+async def append_message(db, message, message_num_per_document, compress_threshold=0, message_db=None):
+    """
+        Append a message to the room message["roomId"], set its _id and seq and return it.
+        Costs two sequential round trips: the room counter, then the message insert and the bucket push together.
+    """
+    await append_messages(db, message["roomId"], [message], message_num_per_document, compress_threshold,
+                          message_db)
+    return message
+
+
+async def append_messages(db, room_id, messages, message_num_per_document, compress_threshold=0, message_db=None):
+    """
+        Append messages to a room in order with one counter update, one insert_many and one $push per bucket.
+        Sets _id and seq of every message. Raises ValueError if the room does not exist and BulkWriteError if some
+        messages could not be inserted, the others are committed.
+        Text content longer than compress_threshold bytes is stored compressed, see compression.py.
+    """
+    message_db = db if message_db is None else message_db
+    room_id = ObjectId(room_id)
+    room = await db.room.find_one_and_update(
+        {"_id": room_id},
+        {"$inc": {"message_num": len(messages)}, "$max": {"update_time": max(m["create_time"] for m in messages)}},
+        projection={"message_num": 1},
+        return_document=pymongo.ReturnDocument.AFTER)
+    if room is None:
+        raise ValueError("Room not exists")
+    seq = room["message_num"] - len(messages)
+    buckets = {}
+    for message in messages:
+        seq += 1
+        message["_id"] = ObjectId()
+        message["seq"] = seq
+        buckets.setdefault((seq - 1) // message_num_per_document, []).append(message["_id"])
+    # A message that fails to insert leaves a dangling id in its bucket, readers skip ids they cannot find.
+    await asyncio.gather(
+        message_db.message.insert_many([pack_content(m, compress_threshold) for m in messages], ordered=False),
+        *[push_to_bucket(db, room_id, index, message_ids, message_num_per_document, message_db)
+          for index, message_ids in buckets.items()])
+
+
+async def push_to_bucket(db, room_id, index, message_ids, message_num_per_document, message_db=None):
+    """
+        Push message ids into bucket index of the room, creating the bucket if needed.
+        The size guard makes the push fail instead of growing a bucket beyond message_num_per_document.
+    """
+    query = {
+        "room_id": room_id,
+        "index": index,
+        "messages.{}".format(message_num_per_document - len(message_ids)): {"$exists": False}
+    }
+    update = {"$push": {"messages": {"$each": message_ids}}}
+    message_db = db if message_db is None else message_db
+    try:
+        result = await message_db.room_message.update_one(query, update, upsert=True)
+    except DuplicateKeyError:
+        # Another sender created the bucket first, now it matches. A full bucket raises again.
+        result = await message_db.room_message.update_one(query, update, upsert=True)
+    if result.upserted_id is not None:
+        await db.room.update_one({"_id": room_id},
+                                 {"$set": {"room_message_id.{}".format(index): result.upserted_id}})
+
+
+def contiguous_from(messages, first_seq, gap_timeout=10):
+    """
+        The messages of contiguous seq starting at first_seq, messages sorted by seq ascending.
+        A message takes its seq before it is inserted, so a later message can be visible before an earlier one of a
+        batch still in flight: the result stops at the first missing seq. A gap whose next message is older than
+        gap_timeout seconds is left behind, its message failed to insert and will never appear.
+    """
+    now = time.time()
+    result = []
+    expected = first_seq
+    for message in messages:
+        if message["seq"] != expected and now - message.get("create_time", 0) < gap_timeout:
+            break
+        result.append(message)
+        expected = message["seq"] + 1
+    return result
@@ -0,0 +1,163 @@
+import json
+
+import pymongo
+from bson.objectid import ObjectId
+
+from compression import unpack_content
+
+"""
+Author: Enigma Zhang
+
+Description:
+    This module keeps the room list of every user up to date in Redis, so that it is drawn with one request.
+
+    Each room has a hash with the seq and create_time of its last message and a preview of it, updated on every
+    send. Each user has a hash of read cursors, the seq of the last message read in each room, set when the user
+    joins, sends or marks a room read. The unread count of a room is its last seq minus the cursor, no message is
+    scanned. Rooms without a hash, after Redis lost its data, are filled from the database on first read.
+"""
+
+ROOM_PREFIX = "chatroom:summary:room:"
+READ_PREFIX = "chatroom:summary:read:"
+PREVIEW_LENGTH = 100
+
+# KEYS[1] room hash, KEYS[2] read cursors of the sender or none, ARGV seq, create_time, preview, room id.
+# Concurrent sends can finish out of order, an older message never replaces a newer one.
+_UPDATE_SCRIPT = """
+local seq = tonumber(ARGV[1])
+local last = tonumber(redis.call('HGET', KEYS[1], 'last_seq') or '0')
+if seq > last then
+    redis.call('HSET', KEYS[1], 'last_seq', ARGV[1], 'update_time', ARGV[2], 'preview', ARGV[3])
+end
+if KEYS[2] then
+    local read = tonumber(redis.call('HGET', KEYS[2], ARGV[4]) or '0')
+    if seq > read then
+        redis.call('HSET', KEYS[2], ARGV[4], ARGV[1])
+    end
+end
+return 1
+"""
+
+# KEYS[1] room hash, KEYS[2...] read cursors of the users joining, ARGV[1] room id.
+_JOIN_SCRIPT = """
+local last = redis.call('HGET', KEYS[1], 'last_seq') or '0'
+for i = 2, #KEYS do
+    redis.call('HSET', KEYS[i], ARGV[1], last)
+end
+return last
+"""
+
+# KEYS[1] read cursors, KEYS[2] room hash, ARGV room id, seq, last seq of the room if it has no hash or ''.
+# Cursors only move forward and never past the last message, returns -1 if the last seq is unknown.
+_READ_SCRIPT = """
+local last = redis.call('HGET', KEYS[2], 'last_seq') or ARGV[3]
+if last == '' then
+    return -1
+end
+local seq = math.min(tonumber(ARGV[2]), tonumber(last))
+local read = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+if seq > read then
+    redis.call('HSET', KEYS[1], ARGV[1], seq)
+    return seq
+end
+return read
+"""
+
+
+def preview(message):
+    """
+        Short form of a message for the room list.
+    """
+    content = message["content"]
+    if message["message_type"] == "text":
+        content = str(content)[:PREVIEW_LENGTH]
+    elif isinstance(content, dict):
+        content = content.get("name", "")
+    return {
+        "userId": str(message["userId"]),
+        "message_type": message["message_type"],
+        "content": content,
+        "seq": message["seq"],
+        "create_time": message.get("create_time", 0),
+    }
+
+
+class RoomSummary:
+    def __init__(self, my_redis, db, partitions=None):
+        self._redis = my_redis
+        self._db = db
+        self._partitions = partitions
+
+    async def on_message(self, message, sender=None):
+        """
+            Record a message just stored as the last of its room, and as read by sender.
+        """
+        room_id = str(message["roomId"])
+        keys = [ROOM_PREFIX + room_id]
+        if sender is not None:
+            keys.append(READ_PREFIX + str(sender))
+        await self._redis.eval(_UPDATE_SCRIPT, len(keys), *keys, message["seq"], message.get("create_time", 0),
+                               json.dumps(preview(message)), room_id)
+
+    async def joined(self, room_id, uids):
+        """
+            Start the read cursors of users joining a room at its last message.
+        """
+        room_id = str(room_id)
+        keys = [ROOM_PREFIX + room_id] + [READ_PREFIX + str(uid) for uid in uids]
+        await self._redis.eval(_JOIN_SCRIPT, len(keys), *keys, room_id)
+
+    async def mark_read(self, uid, room_id, seq):
+        """
+            Move the read cursor of uid in a room to seq, at most the last seq of the room, return the cursor.
+        """
+        keys = [READ_PREFIX + str(uid), ROOM_PREFIX + str(room_id)]
+        cursor = int(await self._redis.eval(_READ_SCRIPT, len(keys), *keys, str(room_id), seq, ""))
+        if cursor < 0:
+            # No hash for the room, after Redis lost its data.
+            room = await self._db.room.find_one({"_id": ObjectId(room_id)},
+                                                projection={"message_num": 1, "update_time": 1})
+            if room is None:
+                raise ValueError("Room id not exists.")
+            last_seq, _, _ = await self._fill(room)
+            cursor = int(await self._redis.eval(_READ_SCRIPT, len(keys), *keys, str(room_id), seq, last_seq))
+        return cursor
+
+    async def summaries(self, uid, rooms):
+        """
+            Summary of the rooms of a user, rooms are room documents. Most recently active first.
+        """
+        room_ids = [str(room["_id"]) for room in rooms]
+        pipe = await self._redis.pipeline(transaction=False)
+        for room_id in room_ids:
+            await pipe.hmget(ROOM_PREFIX + room_id, "last_seq", "update_time", "preview")
+        await pipe.hgetall(READ_PREFIX + str(uid))
+        replies = await pipe.execute()
+        cursors = {key.decode(): int(value) for key, value in replies[-1].items()}
+        result = []
+        for room, (last_seq, update_time, last_message) in zip(rooms, replies[:-1]):
+            room_id = str(room["_id"])
+            if last_seq is None:
+                last_seq, update_time, last_message = await self._fill(room)
+            else:
+                last_seq, update_time, last_message = int(last_seq), int(update_time), json.loads(last_message)
+            result.append({
+                "roomId": room_id,
+                "name": room.get("name"),
+                "message_num": last_seq,
+                "update_time": update_time,
+                "last_message": last_message,
+                "unread": max(0, last_seq - cursors.get(room_id, last_seq)),
+            })
+        result.sort(key=lambda summary: summary["update_time"], reverse=True)
+        return result
+
+    async def _fill(self, room):
+        db = self._partitions.database(room["_id"]) if self._partitions is not None else self._db
+        message = await db.message.find_one({"roomId": str(room["_id"])}, sort=[("seq", pymongo.DESCENDING)])
+        if message is None:
+            # No message, or only archived ones.
+            return int(room.get("message_num", 0)), int(room.get("update_time", 0)), None
+        unpack_content(message)
+        await self.on_message(message)
+        return message["seq"], int(message.get("create_time", 0)), preview(message)
@@ -1,6 +1,10 @@
+import asyncio
 import bcrypt
+import collections
+import concurrent.futures
 import jwt.api_jwt
 import datetime
+import time
 import tornado.log
 
 """
@@ -36,6 +40,48 @@ class Encryption:
         return bcrypt.checkpw(plain, password)
 
 
+class PoolSaturated(Exception):
+    """
+        Raised when too many password jobs are waiting for the password pool.
+    """
+
+
+class PasswordPool:
+    """
+        Runs Encryption in a bounded executor so that bcrypt does not block the event loop.
+        A job is refused with PoolSaturated when max_pending jobs are already waiting or running.
+    """
+
+    def __init__(self, max_workers=4, max_pending=64, use_processes=False):
+        if use_processes:
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers)
+        else:
+            # bcrypt releases the GIL, threads are enough.
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix="password")
+        self._max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+
+    async def encryption(self, password):
+        return await self._run(Encryption.encryption, password)
+
+    async def validation(self, plain, password):
+        return await self._run(Encryption.validation, plain, password)
+
+    async def _run(self, fn, *args):
+        if self.pending >= self._max_pending:
+            self.rejected += 1
+            raise PoolSaturated("Password pool is saturated")
+        self.pending += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
 def token_generate(uid, expired_time=86400):
     key = "secret"
     timestamp = int(datetime.datetime.utcnow().timestamp())
@@ -50,20 +96,104 @@ def token_generate(uid, expired_time=86400):
     return encoded
 
 
-def token_validation(encoded):
+def token_payload(encoded):
     try:
-        payload = jwt.api_jwt.decode(encoded, key="secret",
-                                     algorithms="HS256",
-                                     audience="ENIGMA",
-                                     iss="ENIGMA")
+        return jwt.api_jwt.decode(encoded, key="secret",
+                                  algorithms="HS256",
+                                  audience="ENIGMA",
+                                  iss="ENIGMA")
     except jwt.InvalidTokenError:
         return None
+
+
+def token_validation(encoded):
+    payload = token_payload(encoded)
+    if payload is None:
+        return None
     return payload["uid"]
 
 
-async def auth_with_token(my_redis, authorization):
-    uid = token_validation(authorization)
-    if uid:
-        if await my_redis.exists(uid) is True:
-            return (await my_redis.get(uid)).decode() == authorization
-    return False
+class TokenCache:
+    """
+        Bounded LRU cache of tokens verified against Redis, an entry expires with its token.
+        LoginHandler invalidates the tokens of a uid when it issues a new one. Each invalidation moves the generation
+        of the uid, a token verified before it is not cached after it.
+    """
+
+    def __init__(self, max_size=100000):
+        self._max_size = max_size
+        self._tokens = collections.OrderedDict()
+        self._uids = {}
+        self._generations = collections.OrderedDict()
+        # Moves when a generation is forgotten, so that no put can miss an invalidation.
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        entry = self._tokens.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        uid, exp = entry
+        if exp <= time.time():
+            self._remove(token)
+            self.misses += 1
+            return None
+        self._tokens.move_to_end(token)
+        self.hits += 1
+        return uid
+
+    def generation(self, uid):
+        return self._epoch, self._generations.get(uid, 0)
+
+    def put(self, token, uid, exp, generation=None):
+        """
+            Cache a verified token. generation is the one of the uid before verifying, the token is not cached if the
+            uid was invalidated since.
+        """
+        if generation is not None and generation != self.generation(uid):
+            return
+        self._tokens[token] = (uid, exp)
+        self._tokens.move_to_end(token)
+        self._uids.setdefault(uid, set()).add(token)
+        while len(self._tokens) > self._max_size:
+            self._remove(next(iter(self._tokens)))
+
+    def invalidate(self, uid):
+        for token in self._uids.pop(uid, ()):
+            self._tokens.pop(token, None)
+        self._generations[uid] = self._generations.get(uid, 0) + 1
+        self._generations.move_to_end(uid)
+        while len(self._generations) > self._max_size:
+            self._generations.popitem(last=False)
+            self._epoch += 1
+
+    def _remove(self, token):
+        uid, _ = self._tokens.pop(token)
+        tokens = self._uids.get(uid)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._uids[uid]
+
+
+async def auth_with_token(my_redis, authorization, token_cache=None):
+    """
+        Check that authorization is the current token of its uid and return the uid, None if it is not. Verified
+        tokens are kept in token_cache, a miss costs one Redis GET.
+    """
+    if token_cache is not None:
+        uid = token_cache.get(authorization)
+        if uid is not None:
+            return uid
+    payload = token_payload(authorization)
+    if payload:
+        # A new login during the GET must not let the old token back into the cache.
+        generation = token_cache.generation(payload["uid"]) if token_cache is not None else None
+        current = await my_redis.get(payload["uid"])
+        if current is not None and current.decode() == authorization:
+            if token_cache is not None:
+                token_cache.put(authorization, payload["uid"], payload["exp"], generation)
+            return payload["uid"]
+    return None